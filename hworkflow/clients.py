@@ -0,0 +1,159 @@
+import os
+import time
+import queue
+import pickle
+import threading
+from datetime import timezone
+
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+from googleapiclient.discovery import build
+from github import Github as PyGithub
+
+from hworkflow.ratelimit import get_limiter
+
+_lock = threading.Lock()
+_credentials = {}
+_services = {}
+_http_pools = {}
+_githubs = {}
+_github_locks = {}
+_repos = {}
+
+
+def _load_credentials(secret_file, token_file, scopes, console=True):
+    creds = None
+    if os.path.exists(token_file):
+        with open(token_file, 'rb') as token:
+            creds = pickle.load(token)
+    if creds and not creds.has_scopes(scopes):
+        # Authorized for fewer scopes, e.g. before Drive was needed, authorize again
+        print(f"{token_file} lacks scopes {sorted(set(scopes) - set(creds.scopes or []))}, authorize again")
+        creds = None
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                secret_file, scopes)
+            if console:
+                creds = flow.run_console()
+            else:
+                creds = flow.run_local_server(port=0)
+        with open(token_file, 'wb') as token:
+            pickle.dump(creds, token)
+    return creds
+
+
+def _refresh_loop(creds, token_file, margin):
+    # Refresh before expiry, so that requests never wait for it
+    key = os.path.abspath(token_file)
+    while True:
+        if creds.expiry is None:
+            return
+        # expiry is a naive datetime in UTC
+        expiry = creds.expiry.replace(tzinfo=timezone.utc).timestamp()
+        time.sleep(max(expiry - time.time() - margin, 60))
+        # Replaced by credentials with more scopes
+        if _credentials.get(key) is not creds:
+            return
+        try:
+            creds.refresh(Request())
+            with open(token_file, 'wb') as token:
+                pickle.dump(creds, token)
+        except Exception as e:
+            print(f"Refresh of {token_file} failed: {e!r}")
+
+
+def get_credentials(secret_file, token_file, scopes, refresh_margin=300):
+    r"""
+    OAuth credentials of `token_file` shared by the process, loaded once and refreshed in
+    background `refresh_margin` seconds before they expire.
+    """
+    key = os.path.abspath(token_file)
+    with _lock:
+        creds = _credentials.get(key)
+        if creds is not None and not creds.has_scopes(scopes):
+            scopes = sorted(set(scopes) | set(creds.scopes or []))
+            creds = None
+            # Drop services and connections of the old credentials
+            for k in [k for k in _services if k[2] == key]:
+                del _services[k]
+            _http_pools.pop(key, None)
+        if creds is None:
+            creds = _credentials[key] = _load_credentials(secret_file, token_file, scopes)
+            if creds.refresh_token:
+                threading.Thread(
+                    target=_refresh_loop, args=(creds, token_file, refresh_margin), daemon=True).start()
+    return creds
+
+
+def google_service(api, version, secret_file, token_file, scopes):
+    r"""
+    A googleapiclient service shared by the process, built once. Its requests must be run
+    with `execute`, since HTTP connections are not thread-safe.
+
+    Examples::
+        >>> service = google_service('sheets', 'v4', "credentials.json", "token.pickle", scopes)
+        >>> execute(service.spreadsheets().values().get(spreadsheetId=sheet_id, range="A1"), "token.pickle")
+    """
+    creds = get_credentials(secret_file, token_file, scopes)
+    key = (api, version, os.path.abspath(token_file))
+    with _lock:
+        service = _services.get(key)
+        if service is None:
+            http = AuthorizedHttp(creds, http=httplib2.Http())
+            service = _services[key] = build(api, version, http=http, cache_discovery=False)
+    return service
+
+
+def execute(request, token_file):
+    r"""
+    Execute a request of a service from `google_service` with an HTTP connection of
+    `token_file`. Connections are kept in a pool shared by all threads, so that they are
+    reused by short-lived threads too, and each is used by one thread at a time.
+    """
+    key = os.path.abspath(token_file)
+    with _lock:
+        pool = _http_pools.setdefault(key, queue.LifoQueue())
+    try:
+        http = pool.get_nowait()
+    except queue.Empty:
+        http = AuthorizedHttp(_credentials[key], http=httplib2.Http())
+    try:
+        return request.execute(http=http)
+    finally:
+        pool.put(http)
+
+
+def github_client(access_token):
+    r"""
+    A PyGithub client shared by the process. It is not thread-safe, calls with it or its
+    objects must hold `github_lock(access_token)`.
+    """
+    with _lock:
+        client = _githubs.get(access_token)
+        if client is None:
+            client = _githubs[access_token] = PyGithub(access_token)
+            _github_locks[access_token] = threading.Lock()
+    return client
+
+
+def github_lock(access_token):
+    github_client(access_token)
+    return _github_locks[access_token]
+
+
+def github_repo(access_token, repo_name):
+    r"""
+    A PyGithub repository shared by the process, fetched once.
+    """
+    client = github_client(access_token)
+    key = (access_token, repo_name)
+    with github_lock(access_token):
+        repo = _repos.get(key)
+        if repo is None:
+            repo = _repos[key] = get_limiter('github', access_token).call(client.get_repo, repo_name)
+    return repo
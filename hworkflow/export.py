@@ -0,0 +1,169 @@
+import json
+import math
+
+import numpy as np
+from hhutil.io import fmt_path
+
+from hworkflow.sheets import GoogleSheet
+
+
+def parse_repeats(cell):
+    r"""
+    Values of repeats in a cell of an 'A' column, non-numeric ones are NaN.
+
+    Examples::
+        >>> parse_repeats('80.30\n80.14\n80.22')
+        [80.3, 80.14, 80.22]
+    """
+    values = []
+    for v in cell.split("\n"):
+        v = v.strip()
+        if not v:
+            continue
+        try:
+            values.append(float(v))
+        except ValueError:
+            values.append(math.nan)
+    return values
+
+
+def _to_float(v):
+    try:
+        return float(v)
+    except ValueError:
+        return None
+
+
+class SheetExporter:
+
+    def __init__(self, sheet: GoogleSheet, ranges, update_methods, names=None, sub_sheet='Sheet1',
+                 first_row=2, journal_sheet=None):
+        r"""
+        Export results in columns `ranges` of a sheet to a typed table, one line per row.
+        Cells of 'A' columns become arrays of repeats, 'W' columns numbers if all of them
+        are, otherwise strings.
+
+        The cells are kept in a state file next to the output, so that later exports only
+        fetch rows changed since, found by new lines of `journal_sheet` if results are
+        appended by `GoogleSheet.append_journal`. Otherwise the export is skipped if
+        modifiedTime of the spreadsheet is unchanged, or the whole sheet is fetched in one
+        request.
+
+        Examples::
+            >>> exporter = SheetExporter(sheet, ["L", "M", "N", "O"], ["A", "A", "A", "W"],
+            >>>                          names=["top1", "top5", "loss", "time"])
+            >>> exporter.export("ImageNet.parquet")
+        """
+        assert len(ranges) == len(update_methods)
+        self.sheet = sheet
+        self.ranges = list(ranges)
+        self.update_methods = list(update_methods)
+        self.names = list(names) if names is not None else list(ranges)
+        self.sub_sheet = sub_sheet
+        self.first_row = first_row
+        self.journal_sheet = journal_sheet
+
+    def _load_state(self, state_file):
+        try:
+            state = json.loads(state_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        if state.get('ranges') != self.ranges or state.get('sub_sheet') != self.sub_sheet:
+            return None
+        state['rows'] = {int(r): v for r, v in state['rows'].items()}
+        return state
+
+    def fetch(self, state=None):
+        r"""
+        Return the new state, {'rows': {row: cells}, ...}, fetching only what changed
+        since `state`.
+        """
+        modified_time = self.sheet.modified_time()
+        journal_lines = None
+        changed = None
+        if state is not None:
+            if self.journal_sheet is not None and state.get('journal_lines') is not None:
+                start = state['journal_lines'] + 1
+                lines = self.sheet.read_grid(['A'], first_row=start, sheet=self.journal_sheet)
+                journal_lines = max(lines, default=state['journal_lines'])
+                changed = sorted({int(float(v[0])) for v in lines.values()})
+            elif modified_time is not None and modified_time == state.get('modified_time'):
+                changed = []
+
+        if changed is None:
+            rows = self.sheet.read_grid(self.ranges, first_row=self.first_row, sheet=self.sub_sheet)
+            if self.journal_sheet is not None:
+                journal_lines = max(
+                    self.sheet.read_grid(['A'], first_row=1, sheet=self.journal_sheet), default=0)
+        else:
+            rows = dict(state['rows'])
+            if changed:
+                updated = self.sheet.read_grid(self.ranges, rows=changed, sheet=self.sub_sheet)
+                for r in changed:
+                    rows.pop(r, None)
+                rows.update(updated)
+        return {
+            'ranges': self.ranges,
+            'sub_sheet': self.sub_sheet,
+            'modified_time': modified_time,
+            'journal_lines': journal_lines,
+            'rows': rows,
+        }
+
+    def columns(self, rows):
+        r"""
+        Typed columns of `rows`: 'row', and for each 'A' column `{name}` as a list of
+        repeat arrays, for each 'W' column `{name}` as float64 or str array.
+        """
+        keys = sorted(rows)
+        columns = {'row': np.array(keys, dtype=np.int64)}
+        for i, (name, m) in enumerate(zip(self.names, self.update_methods)):
+            cells = [rows[r][i] for r in keys]
+            if m == 'A':
+                columns[name] = [np.array(parse_repeats(c), dtype=np.float64) for c in cells]
+            else:
+                floats = [_to_float(c) if c else math.nan for c in cells]
+                if None in floats:
+                    columns[name] = np.array(cells, dtype=str)
+                else:
+                    columns[name] = np.array(floats, dtype=np.float64)
+        return columns
+
+    def export(self, out_file, incremental=True):
+        r"""
+        Write the table to `out_file`, Parquet if it ends with .parquet (needs pyarrow),
+        otherwise a compressed .npz, where each 'A' column is stored as flattened
+        `{name}.values` and `{name}.offsets`, the repeats of line i being
+        values[offsets[i]:offsets[i + 1]].
+        """
+        out_file = fmt_path(out_file)
+        state_file = out_file.with_name(out_file.name + ".state.json")
+        state = self._load_state(state_file) if incremental else None
+        new_state = self.fetch(state)
+        if state is not None and new_state['rows'] == state['rows'] and out_file.exists():
+            state_file.write_text(json.dumps(new_state))
+            return out_file
+
+        columns = self.columns(new_state['rows'])
+        if out_file.suffix == ".parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            arrays = {}
+            for name, col in columns.items():
+                if isinstance(col, list):
+                    arrays[name] = pa.array([c.tolist() for c in col], type=pa.list_(pa.float64()))
+                else:
+                    arrays[name] = pa.array(col)
+            pq.write_table(pa.table(arrays), out_file)
+        else:
+            arrays = {}
+            for name, col in columns.items():
+                if isinstance(col, list):
+                    arrays[f"{name}.values"] = np.concatenate(col) if col else np.zeros(0)
+                    arrays[f"{name}.offsets"] = np.cumsum([0] + [len(c) for c in col])
+                else:
+                    arrays[name] = col
+            with open(out_file, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+        state_file.write_text(json.dumps(new_state))
+        return out_file
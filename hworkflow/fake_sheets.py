@@ -0,0 +1,194 @@
+import re
+import sys
+import time
+import argparse
+import threading
+from collections import Counter
+
+from hworkflow.sheets import GoogleSheet, JOURNAL_SEQ, column_index, column_letter
+
+
+def _parse_range(a1):
+    # "Sheet1!K118:O130" -> (sheet, row0, col0, row1, col1), None for open ends
+    sheet, _, cells = a1.rpartition("!")
+    sheet = sheet or "Sheet1"
+    parts = cells.split(":")
+    bounds = []
+    for p in parts:
+        m = re.fullmatch(r"([A-Za-z]*)(\d*)", p)
+        if m is None:
+            raise ValueError(f"Invalid range {a1}")
+        bounds.append((int(m.group(2)) if m.group(2) else None,
+                       column_index(m.group(1)) if m.group(1) else None))
+    (r0, c0), (r1, c1) = bounds[0], bounds[-1]
+    return sheet, r0, c0, r1, c1
+
+
+class _Request:
+
+    def __init__(self, backend, fn):
+        self._backend = backend
+        self._fn = fn
+
+    def execute(self):
+        # Network latency, requests are applied atomically on the server
+        if self._backend.latency:
+            time.sleep(self._backend.latency)
+        with self._backend.lock:
+            return self._fn()
+
+
+class FakeSheets:
+
+    def __init__(self, latency=0.0):
+        r"""
+        An in-memory stand-in of the Sheets API service, with the subset of
+        `spreadsheets().values()` used by `GoogleSheet`. Each request is applied atomically
+        after `latency` seconds. Formulas are stored as text, except `JOURNAL_SEQ`.
+
+        Examples::
+            >>> sheet = GoogleSheet("fake", None, None, service=FakeSheets(latency=0.05))
+            >>> sheet.append_journal(118, ['80.22', '94.65'])
+            1
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.cells = {}
+        self.calls = Counter()
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _read(self, a1, major_dimension='ROWS'):
+        sheet, r0, c0, r1, c1 = _parse_range(a1)
+        if r1 is None:
+            r1 = max([r for (s, r, _c) in self.cells if s == sheet], default=r0 - 1)
+        rows = [[self.cells.get((sheet, r, c), "") for c in range(c0, c1 + 1)] for r in range(r0, r1 + 1)]
+        # Trailing empty cells and rows are omitted like the API
+        rows = [row[:max([i + 1 for i, v in enumerate(row) if v != ""], default=0)] for row in rows]
+        while rows and not rows[-1]:
+            rows.pop()
+        value_range = {'range': a1, 'majorDimension': major_dimension}
+        if rows:
+            value_range['values'] = rows
+        return value_range
+
+    def _write(self, a1, values, input_option):
+        sheet, r0, c0, _, _ = _parse_range(a1)
+        for i, row in enumerate(values):
+            for j, v in enumerate(row):
+                self._set(sheet, r0 + i, c0 + j, v, input_option)
+
+    def _set(self, sheet, row, col, v, input_option):
+        if input_option == "USER_ENTERED" and isinstance(v, str):
+            if v.startswith("'"):
+                v = v[1:]
+            elif v == JOURNAL_SEQ:
+                key = self.cells.get((sheet, row, 1))
+                v = sum(self.cells.get((sheet, r, 1)) == key for r in range(1, row + 1))
+        self.cells[(sheet, row, col)] = v if isinstance(v, str) else str(v)
+
+    def get(self, spreadsheetId, range, **kwargs):
+        self.calls['get'] += 1
+        return _Request(self, lambda: self._read(range))
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS', **kwargs):
+        self.calls['batchGet'] += 1
+        return _Request(self, lambda: {
+            'spreadsheetId': spreadsheetId,
+            'valueRanges': [self._read(r, majorDimension) for r in ranges],
+        })
+
+    def update(self, spreadsheetId, range, valueInputOption, body, **kwargs):
+        self.calls['update'] += 1
+        return _Request(self, lambda: self._write(range, body['values'], valueInputOption))
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        self.calls['batchUpdate'] += 1
+
+        def fn():
+            for d in body['data']:
+                self._write(d['range'], d['values'], body['valueInputOption'])
+        return _Request(self, fn)
+
+    def append(self, spreadsheetId, range, valueInputOption, body, includeValuesInResponse=False, **kwargs):
+        self.calls['append'] += 1
+
+        def fn():
+            sheet, _, c0, _, _ = _parse_range(range)
+            c0 = c0 or 1
+            last = max([r for (s, r, _c) in self.cells if s == sheet], default=0)
+            values = body['values']
+            for i, row in enumerate(values):
+                for j, v in enumerate(row):
+                    self._set(sheet, last + 1 + i, c0 + j, v, valueInputOption)
+            width = max(len(row) for row in values)
+            a1 = f"{sheet}!{column_letter(c0)}{last + 1}:{column_letter(c0 + width - 1)}{last + len(values)}"
+            updates = {'updatedRange': a1, 'updatedRows': len(values)}
+            if includeValuesInResponse:
+                updates['updatedData'] = self._read(a1)
+            return {'spreadsheetId': spreadsheetId, 'updates': updates}
+        return _Request(self, fn)
+
+
+def stress_append(appenders=50, appends=2, row=118, journal=True, latency=0.02):
+    r"""
+    Append results of one row from `appenders` threads at once to a `FakeSheets`, through
+    `append_journal` or the read-modify-write `append_result`. Return the number of results
+    kept, lost, duplicated seqs, requests and elapsed seconds.
+    """
+    backend = FakeSheets(latency)
+    sheet = GoogleSheet("fake", None, None, service=backend)
+    seqs = []
+    barrier = threading.Barrier(appenders)
+
+    def work(i):
+        barrier.wait()
+        for j in range(appends):
+            result = [f"{i}.{j}", f"w{i}.{j}"]
+            if journal:
+                seqs.append(sheet.append_journal(row, result))
+            else:
+                seqs.append(sheet.append_result(row, ['K', 'L'], result, ['A', 'W']))
+
+    start = time.time()
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(appenders)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    if journal:
+        kept = sum(1 for (s, _r, c), v in backend.cells.items() if s == 'Journal' and c == 1 and v == str(row))
+    else:
+        kept = len(backend.cells.get(('Sheet1', row, column_index('K')), "").split())
+    total = appenders * appends
+    return {
+        'kept': kept,
+        'lost': total - kept,
+        'duplicated_seqs': total - len(set(seqs)),
+        'requests': sum(backend.calls.values()),
+        'elapsed': elapsed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare journal and read-modify-write appends under concurrency on a fake sheet")
+    parser.add_argument('--appenders', type=int, default=50)
+    parser.add_argument('--appends', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args(argv)
+    for journal in [False, True]:
+        r = stress_append(args.appenders, args.appends, journal=journal, latency=args.latency)
+        name = "append_journal" if journal else "append_result"
+        print(f"{name:<15} kept {r['kept']:>4} lost {r['lost']:>4} duplicated seqs {r['duplicated_seqs']:>4} "
+              f"requests {r['requests']:>4} {r['elapsed']:.2f}s")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import os
+import threading
+from pathlib import Path
+
+from hhutil.io import fmt_path
+
+
+def find_git_dir(path):
+    r"""
+    Find the git directory of the repo containing `path`, like git does, return
+    (git_dir, common_dir). They differ for linked worktrees, whose `.git` is a file
+    pointing to the real git dir.
+    """
+    path = fmt_path(path).resolve()
+    for d in [path, *path.parents]:
+        dot_git = d / ".git"
+        if dot_git.is_dir():
+            return dot_git, dot_git
+        if dot_git.is_file():
+            line = dot_git.read_text().strip()
+            if not line.startswith("gitdir:"):
+                raise ValueError(f"Invalid {dot_git}")
+            git_dir = Path(line[len("gitdir:"):].strip())
+            if not git_dir.is_absolute():
+                git_dir = (d / git_dir).resolve()
+            common_dir = git_dir
+            if (git_dir / "commondir").is_file():
+                common_dir = (git_dir / (git_dir / "commondir").read_text().strip()).resolve()
+            return git_dir, common_dir
+    raise FileNotFoundError(f"No git repo found at {path}")
+
+
+def _mtime(fp):
+    try:
+        return os.stat(fp).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _read_packed_ref(fp, ref):
+    try:
+        with open(fp) as f:
+            for line in f:
+                if line.startswith(("#", "^")):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+class GitHead:
+
+    def __init__(self, path):
+        r"""
+        Resolve HEAD of the repo containing `path` by reading `HEAD`, loose refs and
+        `packed-refs`, without running git. The commit is cached until one of these files
+        changes.
+
+        Examples::
+            >>> head = GitHead("/root/hanser")
+            >>> head.commit()
+            'f9f9f9c'
+        """
+        self.git_dir, self.common_dir = find_git_dir(path)
+        self._lock = threading.Lock()
+        self._key = None
+        self._sha = None
+
+    def _ref_files(self, ref):
+        # Per-worktree refs live in git_dir, shared refs in common_dir
+        return [self.git_dir / ref, self.common_dir / ref, self.common_dir / "packed-refs"]
+
+    def _resolve(self, ref, depth=0):
+        if depth > 5:
+            raise ValueError(f"Too deep symbolic ref {ref}")
+        for fp in self._ref_files(ref)[:2]:
+            try:
+                content = fp.read_text().strip()
+            except FileNotFoundError:
+                continue
+            if content.startswith("ref:"):
+                return self._resolve(content[len("ref:"):].strip(), depth + 1)
+            return content
+        sha = _read_packed_ref(self.common_dir / "packed-refs", ref)
+        if sha is None:
+            raise ValueError(f"Ref {ref} not found in {self.common_dir}")
+        return sha
+
+    def sha(self):
+        with self._lock:
+            head = self.git_dir / "HEAD"
+            content = head.read_text().strip()
+            ref = content[len("ref:"):].strip() if content.startswith("ref:") else None
+            key = (content, *(_mtime(fp) for fp in (self._ref_files(ref) if ref else [])))
+            if key != self._key:
+                self._sha = self._resolve(ref) if ref else content
+                self._key = key
+            return self._sha
+
+    def commit(self, abbrev=7):
+        r"""
+        The abbreviated commit of HEAD, like `git log --format=%h -n 1`.
+        """
+        return self.sha()[:abbrev]
+
+
+_heads = {}
+_heads_lock = threading.Lock()
+
+
+def repo_commit(path, abbrev=7):
+    r"""
+    The abbreviated HEAD commit of the repo containing `path`, with a shared cache.
+    """
+    path = str(path)
+    with _heads_lock:
+        head = _heads.get(path)
+        if head is None:
+            head = _heads[path] = GitHead(path)
+    return head.commit(abbrev)
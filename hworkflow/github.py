@@ -1,6 +1,9 @@
 from pathlib import Path
 
-from github import Github as PyGithub, InputGitTreeElement
+from github import InputGitTreeElement
+
+from hworkflow.clients import github_client, github_lock, github_repo
+from hworkflow.ratelimit import get_limiter
 
 
 class Github:
@@ -10,23 +13,37 @@ class Github:
         self.folder = folder
         self.access_token = access_token
 
-        self.github = PyGithub(access_token)
-        self.repo = self.github.get_repo(self.repo_name)
+        # Fetch the repo now to fail early
+        self.repo
+
+    @property
+    def github(self):
+        # Shared by all instances of the process, calls must go through _call
+        return github_client(self.access_token)
+
+    @property
+    def repo(self):
+        return github_repo(self.access_token, self.repo_name)
+
+    def _call(self, fn, *args):
+        # PyGithub is not thread-safe
+        with github_lock(self.access_token):
+            return get_limiter('github', self.access_token).call(fn, *args)
 
     def fetch(self, path):
         path = self.folder + "/" + path
-        return self.repo.get_contents(path).decoded_content.decode()
+        return self._call(self.repo.get_contents, path).decoded_content.decode()
 
     def push(self, path, content):
         repo = self.repo
-        master_ref = repo.get_git_ref('heads/main')
+        master_ref = self._call(repo.get_git_ref, 'heads/main')
         master_sha = master_ref.object.sha
-        base_tree = repo.get_git_tree(master_sha)
+        base_tree = self._call(repo.get_git_tree, master_sha)
         elements = [
             InputGitTreeElement(f"{self.folder}/{path}", '100644', 'blob', content)
         ]
-        tree = repo.create_git_tree(elements, base_tree)
-        parent = repo.get_git_commit(master_sha)
+        tree = self._call(repo.create_git_tree, elements, base_tree)
+        parent = self._call(repo.get_git_commit, master_sha)
         commit_message = f'Add {Path(path).name} for {self.folder}'
-        commit = repo.create_git_commit(commit_message, tree, [parent])
-        master_ref.edit(commit.sha)
\ No newline at end of file
+        commit = self._call(repo.create_git_commit, commit_message, tree, [parent])
+        self._call(master_ref.edit, commit.sha)
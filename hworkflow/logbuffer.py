@@ -0,0 +1,90 @@
+import os
+import mmap
+import threading
+
+from hhutil.io import fmt_path
+
+
+def _stat_key(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class LogBuffer:
+
+    def __init__(self, log_file):
+        r"""
+        A log file mapped into memory on first read and shared by everything syncing it, so
+        it is read from disk at most once. Text and lines are decoded once and cached.
+        A change of the file, e.g. by CleanLog, is detected by its inode, size and mtime on
+        each read and drops the cache, `invalidate` does it explicitly.
+
+        Examples::
+            >>> log = LogBuffer("train.log")
+            >>> log.text()
+            >>> log.lines()[-1]
+            >>> log.raw()[:100]
+            >>> log.close()
+        """
+        self.path = fmt_path(log_file)
+        self._lock = threading.RLock()
+        self._key = None
+        self._mm = None
+        self._text = None
+        self._lines = None
+
+    def _check(self):
+        key = _stat_key(os.stat(self.path))
+        if key != self._key:
+            self.invalidate()
+            self._key = key
+
+    def _mapped(self):
+        if self._mm is None and self._key[1] > 0:
+            with open(self.path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mm if self._mm is not None else b""
+
+    def raw(self) -> bytes:
+        with self._lock:
+            self._check()
+            return self._mapped()[:]
+
+    def text(self) -> str:
+        with self._lock:
+            self._check()
+            if self._text is None:
+                self._text = str(self._mapped(), 'utf-8', 'replace')
+            return self._text
+
+    def lines(self):
+        with self._lock:
+            text = self.text()
+            if self._lines is None:
+                self._lines = text.splitlines()
+            return self._lines
+
+    def rebind(self, log_file):
+        r"""
+        Point to a copy of the log, e.g. renamed by RenameLogWithSeq, keeping what is cached.
+        """
+        with self._lock:
+            self.close()
+            self.path = fmt_path(log_file)
+            if self._key is not None:
+                self._key = _stat_key(os.stat(self.path))
+
+    def invalidate(self):
+        with self._lock:
+            self.close()
+            self._key = None
+            self._text = None
+            self._lines = None
+
+    def close(self):
+        r"""
+        Unmap the file, cached text is kept.
+        """
+        with self._lock:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
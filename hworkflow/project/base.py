@@ -1,16 +1,21 @@
 import sys
 import time
 import subprocess
-from itertools import dropwhile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import List, Optional
 import pkg_resources
 
 from github import GithubException
-from hhutil.io import fmt_path, read_lines, write_lines, read_text, rename, copy
+from hhutil.io import fmt_path, rename
 
 from hworkflow.github import Github
+from hworkflow.logbuffer import LogBuffer
+from hworkflow.git import repo_commit
+from hworkflow.retry import RetryPolicy
 from hworkflow.sheets import GoogleSheet
-from hworkflow.utils import retry_fn
+from hworkflow.utils import retry_fn, run_group, read_excerpt, drop_until, clone_file
 
 
 class Project:
@@ -22,7 +27,8 @@ class Project:
     _commit_range: Optional[str] = None
     _dep_repo: Optional[str] = None
 
-    def __init__(self, name, git_repo, sheet_id, access_token, secret_file, token_file, worker_id=0, **env_vars):
+    def __init__(self, name, git_repo, sheet_id, access_token, secret_file, token_file, worker_id=0,
+                 retry_policy=None, sheet_cache_ttl=None, sheet_revision_check=False, **env_vars):
         super().__init__()
         assert len(self._sheet_ranges) == len(self._update_methods)
         self._parse_script_path = self._parse_script
@@ -35,16 +41,17 @@ class Project:
                     "$" + self._dep_repo, self._dep_repo_path)
         self._name = name
         self._github = Github(git_repo, name, access_token)
-        self._sheet = GoogleSheet(sheet_id, secret_file, token_file)
+        self._sheet = GoogleSheet(sheet_id, secret_file, token_file, cache_ttl=sheet_cache_ttl,
+                                  revision_check=sheet_revision_check)
         self._worker_id = worker_id
         self._env_vars = env_vars
+        self._retry_policy = retry_policy or RetryPolicy()
 
         self._python_exe = sys.executable
+        self._launch_commits = {}
 
     def _get_repo_commit(self):
-        fp = fmt_path(self._dep_repo_path)
-        return subprocess.check_output(
-            f'cd {fp} && git log --format="%h" -n 1', shell=True).decode().strip()
+        return repo_commit(self._dep_repo_path)
 
     def fetch_code(self, row):
         content = self._github.fetch(f"code/{row}.py")
@@ -57,11 +64,11 @@ class Project:
             "TASK_ID": name,
             **self._env_vars,
         }
-        python_exe = self._python_exe
-        env_prefix = " ".join([f"{k}={v}" for k, v in envs.items()])
-        cmd = f"{env_prefix} {python_exe} -u {name}.py > {log_file} 2>&1"
-
-        p = subprocess.run(cmd, shell=True)
+        argv = [self._python_exe, "-u", f"{name}.py"]
+        if self._commit_range is not None:
+            # The commit of the code that trains, not the one checked out when syncing
+            self._launch_commits[str(log_file)] = self._get_repo_commit()
+        p = run_group(argv, log_file, envs)
         return p
 
     def check_code(self, row):
@@ -69,7 +76,7 @@ class Project:
 
     def parse_log(self, log_file):
         result = subprocess.check_output(
-            f"{self._python_exe} {self._parse_script_path} -f {log_file}", shell=True).decode().split()
+            [self._python_exe, self._parse_script_path, "-f", str(log_file)]).decode().split()
         return result
 
     def get_log_name(self, row, seq):
@@ -91,38 +98,87 @@ class Project:
         try:
             new_result = self.parse_log(log_file)
         except subprocess.CalledProcessError:
-            print(read_text(log_file))
+            print(read_excerpt(log_file))
             raise ValueError("Log file parse error.")
         ranges = self._sheet_ranges
         update_methods = self._update_methods
         if self._commit_range is not None:
             ranges = [*ranges, self._commit_range]
-            new_result.append(self._get_repo_commit())
+            commit = self._launch_commits.pop(str(log_file), None)
+            new_result.append(commit or self._get_repo_commit())
             update_methods = [*update_methods, 'A']
         seq = self._sheet.append_result(
             row, ranges, new_result, update_methods)
 
         log_name = self.get_log_name(row, seq)
         print(log_name)
-        self.push_log(log_name, read_text(log_file))
+        log = LogBuffer(log_file)
+        try:
+            self.push_log(log_name, log.text())
+        finally:
+            log.close()
         log_file = fmt_path(log_file)
-        copy(log_file, log_file.with_name(log_name + log_file.suffix))
+        clone_file(log_file, log_file.with_name(log_name + log_file.suffix))
         return seq
 
-    def run_repeat(self, row, max_repeat=5):
+    def _count_repeats(self, row):
+        i = self._update_methods.index('A')
+        values = self._sheet.read_values([f"{self._sheet_ranges[i]}{row}"])[0]
+        return len(values[0].split()) if values else 0
+
+    def _run_repeat_pipelined(self, row, max_repeat, max_inflight):
+        assert 'A' in self._update_methods, "Repeat count needs an append column"
+        # One uploader keeps sheet sequence numbers in the order of runs
+        executor = ThreadPoolExecutor(max_workers=1)
+        pending = deque()
+        expected = self._count_repeats(row)
+        i = 0
+        try:
+            while expected < max_repeat:
+                # Log files in use: one for training, at most `max_inflight` for uploading
+                log_file = f"train.{i % (max_inflight + 1)}.log"
+                i += 1
+                p = self.run_script(row, log_file)
+                if p.returncode != 0:
+                    # Runtime error, left to user
+                    print(read_excerpt(log_file))
+                    break
+
+                drop_until(log_file, b"Start training")
+
+                pending.append(executor.submit(
+                    retry_fn, partial(self.sync_result, row, log_file), 3,
+                    catch=(BrokenPipeError,), interval=10))
+                expected += 1
+                while len(pending) > max_inflight:
+                    seq = pending.popleft().result()
+                    expected = max(expected, seq + len(pending))
+            while pending:
+                pending.popleft().result()
+        finally:
+            executor.shutdown(wait=True)
+
+    def run_repeat(self, row, max_repeat=5, pipeline=False, max_inflight=1):
+        r"""
+        Run `row` until it has `max_repeat` results in the sheet.
+
+        Args:
+            pipeline: if True, upload results of a run in background while the next run trains.
+            max_inflight: max number of uploads in background in pipeline mode.
+        """
         self.check_code(row)
+        if pipeline:
+            return self._run_repeat_pipelined(row, max_repeat, max_inflight)
 
         while True:
             log_file = "train.log"
             p = self.run_script(row, log_file)
             if p.returncode != 0:
                 # Runtime error, left to user
-                print(read_text(log_file))
+                print(read_excerpt(log_file))
                 break
 
-            lines = read_lines(log_file)
-            lines = list(dropwhile(lambda l: 'Start training' not in l, lines))
-            write_lines(lines, log_file)
+            drop_until(log_file, b"Start training")
 
             seq = retry_fn(lambda: self.sync_result(row, log_file), 3,
                            catch=(BrokenPipeError,), interval=10)
@@ -131,71 +187,44 @@ class Project:
             if seq >= max_repeat:
                 break
 
+    def _run_until_success(self, name, log_file, max_retry):
+        # Returns whether the script finally succeeded
+        session = self._retry_policy.session(max_retry)
+        while True:
+            p = self.run_script(name, log_file)
+            if p.returncode == 0:
+                self._retry_policy.record(True)
+                return True
+            error_log = read_excerpt(log_file)
+            # TODO: Connection timed out. The process will not return and block forever.
+            kind = self._retry_policy.classify(error_log)
+            if kind is None:
+                # Unknown error, left to user
+                print(error_log)
+                return False
+            delay = session.next_delay(kind)
+            if delay is None:
+                return False
+            time.sleep(delay)
+
     def run_retry(self, row, max_retry=10):
         self.check_code(row)
 
-        retry = 0
-        while retry <= max_retry:
-            log_file = f"train.log"
-            p = self.run_script(row, log_file)
-            if p.returncode != 0:
-                error_log = read_text(log_file)
-
-                # Network error, resolve by retry
-                possible_errors = [
-                    "Socket closed",
-                    "Connection reset by peer",
-                    "Stage end",
-                    "Infinite encountered",
-                ]
-                # TODO: Connection timed out. The process will not return and block forever.
-                if any(e in error_log for e in possible_errors):
-                    retry += 1
-                    time.sleep(30)
-                    continue
-                else:
-                    # Unknown error, left to user
-                    print(error_log)
-                    break
+        log_file = f"train.log"
+        if not self._run_until_success(row, log_file, max_retry):
+            return
 
-            lines = read_lines(log_file)
-            lines = list(dropwhile(lambda l: 'Start training' not in l, lines))
-            write_lines(lines, log_file)
+        drop_until(log_file, b"Start training")
 
-            retry_fn(lambda: self.sync_result(row, log_file), 3,
-                     catch=(BrokenPipeError,), interval=10)
-            break
+        retry_fn(lambda: self.sync_result(row, log_file), 3,
+                 catch=(BrokenPipeError,), interval=10)
 
     def _run_retry(self, name, max_retry=10):
-        retry = 0
-        while retry <= max_retry:
-            log_file = f"train.log"
-            p = self.run_script(name, log_file)
-            if p.returncode != 0:
-                error_log = read_text(log_file)
-
-                # Network error, resolve by retry
-                possible_errors = [
-                    "Socket closed",
-                    "Connection reset by peer",
-                    "Stage end",
-                    "Infinite encountered",
-                    "Killed", # local memory usage exceeded
-                ]
-                # TODO: Connection timed out. The process will not return and block forever.
-                if any(e in error_log for e in possible_errors):
-                    retry += 1
-                    time.sleep(30)
-                    continue
-                else:
-                    # Unknown error, left to user
-                    print(error_log)
-                    break
+        log_file = f"train.log"
+        if not self._run_until_success(name, log_file, max_retry):
+            return
 
-            lines = read_lines(log_file)
-            lines = list(dropwhile(lambda l: 'Start training' not in l, lines))
-            write_lines(lines, log_file)
-            break
+        drop_until(log_file, b"Start training")
 
     def run_retry2(self, row, max_retry=10):
         self.run_retry(row, max_retry)
@@ -0,0 +1,167 @@
+import os
+import time
+import fcntl
+import hashlib
+import struct
+import tempfile
+import threading
+from email.utils import parsedate_to_datetime
+
+from hhutil.io import fmt_path, time_now
+
+# requests per second and burst of each API, shared by processes of a host
+LIMITS = {
+    # 60 requests per minute per user
+    'sheets': (1.0, 10),
+    # secondary limits on content creation, 80 per minute
+    'github': (1.0, 5),
+}
+
+_STATE = struct.Struct("ddd")
+
+
+class RateLimiter:
+
+    def __init__(self, name, rate, burst, state_dir=None, key=None):
+        r"""
+        A token bucket shared by processes of the host through a file locked with `flock`,
+        `rate` tokens are added per second up to `burst`. When an API answers 429 or a rate
+        limited 403, all processes stop calling it until its `Retry-After`.
+
+        Buckets are per OS user and per `key`, e.g. the token of the API, since limits are
+        per account. If the state file can't be used, the bucket is kept in the process.
+
+        Examples::
+            >>> limiter = RateLimiter('sheets', rate=1, burst=10, key="token.pickle")
+            >>> limiter.call(request.execute)
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        state_dir = fmt_path(state_dir or tempfile.gettempdir())
+        suffix = "" if key is None else "-" + hashlib.sha256(str(key).encode()).hexdigest()[:16]
+        self.state_file = state_dir / f"hworkflow-{name}-{os.getuid()}{suffix}.bucket"
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _update(self, fn):
+        # fn(tokens, blocked_until, now) -> (tokens, blocked_until, result)
+        with self._lock:
+            if self._state is None:
+                try:
+                    return self._update_file(fn)
+                except OSError as e:
+                    print(f"{time_now()} Can't use {self.state_file}: {e!r}, limit {self.name} in this process only")
+                    self._state = _STATE.pack(self.burst, time.time(), 0)
+            self._state, result = self._apply(fn, self._state)
+            return result
+
+    def _update_file(self, fn):
+        with open(os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data, result = self._apply(fn, f.read(_STATE.size))
+            f.seek(0)
+            f.write(data)
+            return result
+
+    def _apply(self, fn, data):
+        now = time.time()
+        if len(data) == _STATE.size:
+            tokens, last, blocked_until = _STATE.unpack(data)
+            tokens = min(self.burst, tokens + max(now - last, 0) * self.rate)
+        else:
+            tokens, blocked_until = self.burst, 0
+        tokens, blocked_until, result = fn(tokens, blocked_until, now)
+        return _STATE.pack(tokens, now, blocked_until), result
+
+    def acquire(self, n=1):
+        r"""
+        Take `n` tokens, wait until they are available.
+        """
+        def take(tokens, blocked_until, now):
+            if blocked_until > now:
+                return tokens, blocked_until, blocked_until - now
+            if tokens >= n:
+                return tokens - n, blocked_until, 0
+            return tokens, blocked_until, (n - tokens) / self.rate
+
+        while True:
+            wait = self._update(take)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def block(self, seconds):
+        r"""
+        Stop all processes from calling the API for `seconds`.
+        """
+        self._update(lambda tokens, blocked_until, now: (0, max(blocked_until, now + seconds), None))
+
+    def call(self, fn, *args, max_retry=5, **kwargs):
+        r"""
+        Call `fn` when a token is available, and again after the delay the API asks for if
+        it is rate limited.
+        """
+        for i in range(max_retry + 1):
+            self.acquire()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or i == max_retry:
+                    raise e
+                print(f"{time_now()} {self.name} rate limited, wait {delay:.1f}s")
+                self.block(delay)
+
+
+def _parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(e, default=30):
+    r"""
+    Seconds to wait if `e` is a rate limit error of googleapiclient or PyGithub, else None.
+    """
+    status = getattr(e, 'status', None)
+    if status is None and getattr(e, 'resp', None) is not None:
+        status = getattr(e.resp, 'status', None)
+    if status not in (429, 403):
+        return None
+    headers = getattr(e, 'headers', None) or getattr(e, 'resp', None) or {}
+    headers = {k.lower(): v for k, v in dict(headers).items()}
+    delay = _parse_retry_after(headers.get('retry-after'))
+    if delay is not None:
+        return delay
+    if headers.get('x-ratelimit-remaining') == '0' and 'x-ratelimit-reset' in headers:
+        return max(float(headers['x-ratelimit-reset']) - time.time(), 1)
+    if status == 429:
+        return default
+    # 403 is a rate limit only if it says so, otherwise a permission error
+    if 'rate' in str(e).lower() and 'limit' in str(e).lower():
+        return default
+    return None
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name, key=None):
+    r"""
+    The limiter of API `name` in `LIMITS` for the account `key`, shared by the process.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get((name, key))
+        if limiter is None:
+            rate, burst = LIMITS[name]
+            limiter = _limiters[(name, key)] = RateLimiter(name, rate, burst, key=key)
+    return limiter
@@ -0,0 +1,139 @@
+import re
+import random
+import threading
+from collections import deque
+
+
+class ErrorClass:
+
+    def __init__(self, name, patterns=(), max_retry=10, base_interval=30, min_interval=None,
+                 max_interval=600, factor=2, jitter=0.1):
+        r"""
+        A class of failures that share the same retry budget and backoff.
+
+        Args:
+            patterns: regexes recognizing the failure in the log.
+            max_retry: retry budget of this class in one task.
+            base_interval: interval of the first retry, doubled (`factor`) on each retry.
+            min_interval: interval of the first retry when recent runs were healthy.
+            jitter: relative random noise added to intervals.
+        """
+        self.name = name
+        self.patterns = list(patterns)
+        self.max_retry = max_retry
+        self.base_interval = base_interval
+        self.min_interval = base_interval if min_interval is None else min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+
+    def interval(self, n, healthy):
+        if n == 1 and healthy:
+            t = self.min_interval
+        else:
+            t = min(self.base_interval * self.factor ** (n - 1), self.max_interval)
+        return t * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+def default_error_classes(interval=30):
+    return [
+        ErrorClass('network', [
+            re.escape("Socket closed"),
+            re.escape("Connection reset by peer"),
+        ], max_retry=10, base_interval=10, min_interval=3, max_interval=300),
+        ErrorClass('functional', [
+            re.escape("Stage end"),
+            re.escape("Infinite encountered"),
+            r"loss: nan\b",
+        ], max_retry=10, base_interval=interval),
+        # local memory usage exceeded
+        ErrorClass('oom', [r"\bKilled\b"], max_retry=3, base_interval=interval * 2),
+        # detected by the runner, no pattern
+        ErrorClass('hang', [], max_retry=5, base_interval=interval),
+    ]
+
+
+class RetryPolicy:
+
+    def __init__(self, error_classes=None, window=10, healthy_ratio=0.8):
+        r"""
+        Classify failures of tasks and decide whether and when to retry them.
+
+        A short window of recent run outcomes is kept, when most of them succeeded, the
+        first retry of a class waits only `min_interval`, so a transient network blip
+        costs a few seconds instead of a full interval.
+
+        Examples::
+            >>> policy = RetryPolicy()
+            >>> session = policy.session(max_retry=10)
+            >>> kind = policy.classify(error_log)
+            'network'
+            >>> session.next_delay(kind)
+            3.1
+            >>> session.next_delay(None) # unknown error
+            None
+        """
+        if error_classes is None:
+            error_classes = default_error_classes()
+        self.error_classes = {c.name: c for c in error_classes}
+        self.healthy_ratio = healthy_ratio
+        self._history = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._regex = None
+
+    def patterns(self):
+        # Classes without patterns, e.g. 'hang', are detected by the runner
+        return [(c.name, p) for c in self.error_classes.values() for p in c.patterns]
+
+    def classify(self, text):
+        ps = self.patterns()
+        if not ps:
+            return None
+        if self._regex is None:
+            self._regex = re.compile("|".join(f"(?P<e{i}>{p})" for i, (_name, p) in enumerate(ps)))
+        m = self._regex.search(text)
+        if m is None:
+            return None
+        return ps[int(m.lastgroup[1:])][0]
+
+    def record(self, success):
+        with self._lock:
+            self._history.append(success)
+
+    def healthy(self):
+        with self._lock:
+            if not self._history:
+                return True
+            return sum(self._history) / len(self._history) >= self.healthy_ratio
+
+    def session(self, max_retry=10):
+        return RetrySession(self, max_retry)
+
+
+class RetrySession:
+
+    def __init__(self, policy, max_retry):
+        r"""
+        Retry state of one task, created by `RetryPolicy.session`.
+        """
+        self.policy = policy
+        self.max_retry = max_retry
+        self.retries = 0
+        self.counts = {}
+
+    def next_delay(self, kind):
+        r"""
+        Record a failure of class `kind`, return seconds to sleep before retrying, or
+        None if it is unknown or the retry budget is exhausted.
+        """
+        healthy = self.policy.healthy()
+        self.policy.record(False)
+        c = self.policy.error_classes.get(kind)
+        if c is None:
+            return None
+        n = self.counts.get(kind, 0) + 1
+        self.counts[kind] = n
+        self.retries += 1
+        if n > c.max_retry or self.retries > self.max_retry:
+            return None
+        return c.interval(n, healthy)
@@ -1,21 +1,16 @@
 import sys
 import time
-import subprocess
-from itertools import dropwhile
-from hhutil.io import read_lines, write_lines, read_text
 
-ERRORS = [
-    "Socket closed",
-    "Connection reset by peer",
-    "Stage end",
-    "Infinite encountered",
-]
+from hworkflow.retry import RetryPolicy
+from hworkflow.utils import run_group, read_excerpt, drop_until
+
 
 class Runner:
 
-    def __init__(self, **env_vars):
+    def __init__(self, retry_policy=None, **env_vars):
         super().__init__()
         self._env_vars = env_vars
+        self._retry_policy = retry_policy or RetryPolicy()
 
         self._python_exe = sys.executable
 
@@ -24,33 +19,31 @@ class Runner:
             "TASK_ID": name,
             **self._env_vars,
         }
-        python_exe = self._python_exe
-        env_prefix = " ".join([f"{k}={v}" for k, v in envs.items()])
-        cmd = f"{env_prefix} {python_exe} -u {name}.py > {log_file} 2>&1"
-
-        p = subprocess.run(cmd, shell=True)
+        argv = [self._python_exe, "-u", f"{name}.py"]
+        p = run_group(argv, log_file, envs)
         return p
 
     def run_retry(self, name, max_retry=10, skip_errors=None):
-        retry = 0
-        while retry <= max_retry:
+        session = self._retry_policy.session(max_retry)
+        while True:
             log_file = f"{name}.log"
             p = self.run_script(name, log_file)
             if p.returncode != 0:
-                error_log = read_text(log_file)
-
-                skip_errors = skip_errors or []
-                possible_errors = ERRORS + list(skip_errors)
-                if any(e in error_log for e in possible_errors):
-                    retry += 1
-                    time.sleep(30)
-                    continue
-                else:
+                error_log = read_excerpt(log_file)
+
+                kind = self._retry_policy.classify(error_log)
+                if kind is None and any(e in error_log for e in skip_errors or []):
+                    kind = 'functional'
+                if kind is None:
                     # Unknown error, left to user
                     print(error_log)
                     break
+                delay = session.next_delay(kind)
+                if delay is None:
+                    break
+                time.sleep(delay)
+                continue
 
-            lines = read_lines(log_file)
-            lines = list(dropwhile(lambda l: 'Start training' not in l, lines))
-            write_lines(lines, log_file)
+            self._retry_policy.record(True)
+            drop_until(log_file, b"Start training")
             break
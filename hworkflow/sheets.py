@@ -1,35 +1,200 @@
 import os
-import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import re
+import time
+import threading
+from googleapiclient.errors import HttpError
+
+from hworkflow.clients import get_credentials, google_service, execute
+from hworkflow.ratelimit import get_limiter
+from hworkflow.utils import datetime_now
+
+
+# Lines of a journal are [row, seq, time, *result]
+JOURNAL_SEQ = '=COUNTIF(INDIRECT("A1:A"&ROW()),INDIRECT("A"&ROW()))'
+JOURNAL_RESULT_COLUMN = 4
+
+
+class SheetCache:
+
+    def __init__(self, ttl=300):
+        r"""
+        Values of cells keyed by (spreadsheet, sheet, row, column), expired after `ttl`
+        seconds. Empty cells are cached as "".
+        """
+        self.ttl = ttl
+        self._cells = {}
+        self._lock = threading.Lock()
+
+    def get(self, spreadsheet_id, sheet, cells):
+        r"""
+        Values of all `cells`, a list of (row, column), or None if any is missing or expired.
+        """
+        now = time.time()
+        values = []
+        with self._lock:
+            for row, col in cells:
+                item = self._cells.get((spreadsheet_id, sheet, row, col))
+                if item is None or now - item[1] > self.ttl:
+                    return None
+                values.append(item[0])
+        return values
+
+    def put(self, spreadsheet_id, sheet, values):
+        r"""
+        Args:
+            values: dict of (row, column) to value.
+        """
+        now = time.time()
+        with self._lock:
+            for (row, col), v in values.items():
+                self._cells[(spreadsheet_id, sheet, row, col)] = (v, now)
+
+    def invalidate(self, spreadsheet_id=None, sheet=None):
+        with self._lock:
+            if spreadsheet_id is None:
+                self._cells.clear()
+                return
+            self._cells = {
+                k: v for k, v in self._cells.items()
+                if k[0] != spreadsheet_id or (sheet is not None and k[1] != sheet)
+            }
 
 
 class GoogleSheet:
     scopes = ['https://www.googleapis.com/auth/spreadsheets']
+    # Needed by revision_check to read modifiedTime
+    revision_scopes = ['https://www.googleapis.com/auth/drive.metadata.readonly']
 
-    def __init__(self, spreadsheet_id, secret_file, token_file) -> None:
-        self.service = self._init_service(secret_file, token_file)
+    def __init__(self, spreadsheet_id, secret_file, token_file, cache_ttl=None,
+                 revision_check=False, revision_interval=10, service=None) -> None:
+        r"""
+        Args:
+            cache_ttl: if not None, cache values read and written for `cache_ttl` seconds,
+                so that a worker who is the only writer of its rows doesn't read them back.
+                Appends use cached values only with `revision_check`, otherwise an append
+                of another writer within the TTL would be overwritten.
+            revision_check: drop the cache when the spreadsheet is modified by others,
+                checked by its modifiedTime in Drive at most every `revision_interval`
+                seconds, and before each write. It adds the scope `drive.metadata.readonly`,
+                so existing tokens are authorized again on first use. If Drive is still
+                not readable, only TTL is used.
+            service: a service to use instead of Google's, e.g. `FakeSheets`, which is
+                neither authorized nor rate limited.
+        """
+        self.secret_file = secret_file
+        self.token_file = token_file
+        self._service = service
         self.spreadsheet_id = spreadsheet_id
+        self.cache = SheetCache(cache_ttl) if cache_ttl is not None else None
+        self.revision_interval = revision_interval
+        self._revision_check = self.cache is not None and revision_check
+        if self._revision_check:
+            self.scopes = self.scopes + self.revision_scopes
+        if service is None:
+            get_credentials(secret_file, token_file, self.scopes)
+        self._modified_time = None
+        self._checked = 0
 
-    def _init_service(self, secret_file, token_file, console=True):
-        creds = None
-        if os.path.exists(token_file):
-            with open(token_file, 'rb') as token:
-                creds = pickle.load(token)
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    secret_file, self.scopes)
-                if console:
-                    creds = flow.run_console()
-                else:
-                    creds = flow.run_local_server(port=0)
-            with open(token_file, 'wb') as token:
-                pickle.dump(creds, token)
-        return build('sheets', 'v4', credentials=creds, cache_discovery=False)
+    def invalidate(self, sheet=None):
+        r"""
+        Drop cached values of `sheet`, or all sheets of the spreadsheet.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(self.spreadsheet_id, sheet)
+
+    def _validate_cache(self, force=False):
+        if not self._revision_check or (not force and time.time() - self._checked < self.revision_interval):
+            return
+        modified_time = self._check_modified_time()
+        if modified_time is not None and self._modified_time is not None and modified_time != self._modified_time:
+            self.invalidate()
+        self._modified_time = modified_time
+
+    def _check_modified_time(self):
+        modified_time = self.modified_time()
+        if modified_time is None:
+            print(f"Revision check of {self.spreadsheet_id} failed, use TTL only")
+            self._revision_check = False
+            return None
+        self._checked = time.time()
+        return modified_time
+
+    def _cached(self, sheet, cells):
+        if self.cache is None:
+            return None
+        self._validate_cache()
+        return self.cache.get(self.spreadsheet_id, sheet, cells)
+
+    def _cache_put(self, sheet, values, write=False):
+        if self.cache is not None:
+            self.cache.put(self.spreadsheet_id, sheet, values)
+            if write and self._revision_check:
+                # The modification of our write, any later one is by others
+                self._modified_time = self._check_modified_time()
+
+    @property
+    def service(self):
+        if self._service is not None:
+            return self._service
+        # Shared by threads, requests are run with HTTP connections of a pool
+        return google_service('sheets', 'v4', self.secret_file, self.token_file, self.scopes)
+
+    def _execute(self, request):
+        if self._service is not None:
+            return request.execute()
+        return get_limiter('sheets', os.path.abspath(self.token_file)).call(execute, request, self.token_file)
+
+    def _drive(self):
+        return google_service('drive', 'v3', self.secret_file, self.token_file, self.scopes)
+
+    def modified_time(self):
+        r"""
+        modifiedTime of the spreadsheet in Drive, or None if unavailable, e.g. no Drive scope.
+        """
+        if self._service is not None:
+            return None
+        try:
+            return self._execute(self._drive().files().get(
+                fileId=self.spreadsheet_id, fields='modifiedTime'))['modifiedTime']
+        except HttpError:
+            return None
+
+    def read_grid(self, cols, rows=None, first_row=1, sheet='Sheet1', render='FORMATTED_VALUE'):
+        r"""
+        Read cells of columns `cols` in `rows`, or all rows from `first_row`, with one
+        batchGet of merged ranges. Return {row: [value of each column]} of rows having
+        any value, empty cells are "". `render` is the valueRenderOption, e.g. 'FORMULA'.
+
+        Examples::
+            >>> self.read_grid(['K', 'L'], first_row=2)
+            {2: ['80.30\n80.14', '94.68\n94.62'], 5: ['79.17', '']}
+        """
+        col_indices = [column_index(c) for c in cols]
+        col_runs = _runs(col_indices)
+        if rows is None:
+            row_runs = [(first_row, None)]
+        else:
+            row_runs = _runs(rows)
+        rects = [(r0, r1, c0, c1) for r0, r1 in row_runs for c0, c1 in col_runs]
+        if not rects:
+            return {}
+        range_names = [
+            f"{sheet}!{column_letter(c0)}{r0}:{column_letter(c1)}{'' if r1 is None else r1}"
+            for r0, r1, c0, c1 in rects
+        ]
+        response = self._execute(self.service.spreadsheets().values().batchGet(
+            spreadsheetId=self.spreadsheet_id, ranges=range_names, majorDimension='ROWS',
+            valueRenderOption=render))
+        cells = {}
+        for (r0, _r1, c0, _c1), value_range in zip(rects, response.get('valueRanges', [])):
+            for i, values in enumerate(value_range.get('values', [])):
+                for j, v in enumerate(values):
+                    if v != "":
+                        cells[(r0 + i, c0 + j)] = v
+        grid = {}
+        for r in sorted({r for r, _c in cells}):
+            grid[r] = [cells.get((r, c), "") for c in col_indices]
+        return grid
 
     def read_values(self, ranges, sheet='Sheet1'):
         r"""
@@ -46,15 +211,22 @@ class GoogleSheet:
         """
         if isinstance(ranges, str):
             range_name = f'{sheet}!{ranges}'
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=self.spreadsheet_id, range=range_name).execute()
+            result = self._execute(self.service.spreadsheets().values().get(
+                spreadsheetId=self.spreadsheet_id, range=range_name))
             values = result.get('values', [])[0]
         else:
+            cells = [parse_cell(r) for r in ranges]
+            if None not in cells:
+                cached = self._cached(sheet, cells)
+                if cached is not None:
+                    return [[v] if v != "" else [] for v in cached]
             range_names = [f'{sheet}!{range}' for range in ranges]
-            result = self.service.spreadsheets().values().batchGet(
-                spreadsheetId=self.spreadsheet_id, ranges=range_names).execute()
+            result = self._execute(self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id, ranges=range_names))
             values = result.get('valueRanges', [])
             values = [v.get("values", [[]])[0] for v in values]
+            if None not in cells:
+                self._cache_put(sheet, {c: v[0] if v else "" for c, v in zip(cells, values)})
         return values
 
     def update_values(self, ranges, values, sheet='Sheet1'):
@@ -64,14 +236,21 @@ class GoogleSheet:
             >>>
             >>> self.update_values(['K121', 'L121'], [['79.17'], ['94.29']])
         """
+        # Modifications by others before the write must not be taken as ours
+        self._validate_cache(force=True)
         if isinstance(ranges, str):
             range_name = f'{sheet}!{ranges}'
             body = {
                 'values': [values],
             }
-            return self.service.spreadsheets().values().update(
+            result = self._execute(self.service.spreadsheets().values().update(
                 spreadsheetId=self.spreadsheet_id, range=range_name,
-                valueInputOption="RAW", body=body).execute()
+                valueInputOption="RAW", body=body))
+            cell = parse_cell(ranges.split(":")[0])
+            if cell is not None:
+                row, col = cell
+                self._cache_put(sheet, {(row, col + j): v for j, v in enumerate(values)}, write=True)
+            return result
         else:
             range_names = [f'{sheet}!{range}' for range in ranges]
             data = [
@@ -82,8 +261,15 @@ class GoogleSheet:
                 "valueInputOption": "RAW",
                 "data": data,
             }
-            return self.service.spreadsheets().values().batchUpdate(
-                spreadsheetId=self.spreadsheet_id, body=body).execute()
+            result = self._execute(self.service.spreadsheets().values().batchUpdate(
+                spreadsheetId=self.spreadsheet_id, body=body))
+            written = {}
+            for r, v in zip(ranges, values):
+                cell = parse_cell(r)
+                if cell is not None and len(v) == 1:
+                    written[cell] = v[0]
+            self._cache_put(sheet, written, write=True)
+            return result
 
 
     def append_result(self, row, ranges, result, update_methods, sheet='Sheet1'):
@@ -95,17 +281,207 @@ class GoogleSheet:
             >>> seq
             2
         """
-        assert len(ranges) == len(result) == len(update_methods)
-        ranges = [f"{r}{row}" for r in ranges]
-        results = self.read_values(ranges, sheet=sheet)
-        results = update_results(results, result, update_methods)
-        self.update_values(ranges, results, sheet=sheet)
-        if 'A' not in update_methods:
-            seq = 1
+        return self.append_results([(row, result)], ranges, update_methods, sheet=sheet)[0]
+
+    def append_results(self, row_results, ranges, update_methods, sheet='Sheet1'):
+        r"""
+        Append results of many rows with one batchGet and one batchUpdate. Adjacent rows and
+        columns are merged into rectangular ranges, e.g. K118:O130. Results of the same row
+        are appended in order.
+
+        Examples::
+            >>> row_results = [(118, ['80.22', '94.65']), (119, ['80.01', '94.60']), (118, ['80.40', '94.71'])]
+            >>> self.append_results(row_results, ['K', 'L'], ['A', 'A'])
+            [2, 1, 3]
+        """
+        assert len(ranges) == len(update_methods)
+        if not row_results:
+            return []
+        cols = [column_index(r) for r in ranges]
+        col_runs = _runs(cols)
+        row_runs = _runs([row for row, _ in row_results])
+        all_cells = [(r, c) for r0, r1 in row_runs for r in range(r0, r1 + 1) for c in cols]
+        self._validate_cache(force=True)
+        # Only changes by others can be detected with revision checks, not with TTL
+        cached = self._cached(sheet, all_cells) if self._revision_check else None
+        if cached is not None:
+            cells = {k: v for k, v in zip(all_cells, cached) if v != ""}
+        else:
+            range_names = [
+                f"{sheet}!{column_letter(c0)}{r0}:{column_letter(c1)}{r1}"
+                for r0, r1 in row_runs for c0, c1 in col_runs
+            ]
+            response = self._execute(self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id, ranges=range_names, majorDimension='ROWS'))
+            cells = {}
+            rects = [(r0, c0) for r0, r1 in row_runs for c0, c1 in col_runs]
+            for (r0, c0), value_range in zip(rects, response.get('valueRanges', [])):
+                for i, values in enumerate(value_range.get('values', [])):
+                    for j, v in enumerate(values):
+                        cells[(r0 + i, c0 + j)] = v
+
+        seqs = []
+        for row, result in row_results:
+            assert len(result) == len(ranges)
+            results = [[cells[(row, c)]] if (row, c) in cells else [] for c in cols]
+            results = update_results(results, result, update_methods)
+            for c, v in zip(cols, results):
+                cells[(row, c)] = v[0]
+            if 'A' not in update_methods:
+                seqs.append(1)
+            else:
+                i = update_methods.index('A')
+                seqs.append(len(results[i][0].split()))
+
+        data = []
+        for r0, r1 in row_runs:
+            for c0, c1 in col_runs:
+                values = [[cells.get((r, c), "") for c in range(c0, c1 + 1)] for r in range(r0, r1 + 1)]
+                data.append({"range": f"{sheet}!{column_letter(c0)}{r0}:{column_letter(c1)}{r1}",
+                             "values": values})
+        body = {
+            "valueInputOption": "RAW",
+            "data": data,
+        }
+        self._execute(self.service.spreadsheets().values().batchUpdate(
+            spreadsheetId=self.spreadsheet_id, body=body))
+        self._cache_put(sheet, {k: cells.get(k, "") for k in all_cells}, write=True)
+        return seqs
+
+    def append_journal(self, row, result, sheet='Journal'):
+        r"""
+        Append `result` of `row` as a new line of the journal `sheet` in one values.append
+        call, and return its seq. A line is [row, seq, time, *result], where seq is computed
+        by the sheet from lines above, so concurrent appends of the same row never overwrite
+        each other and get distinct seqs. Show results in the main sheet with `link_journal`.
+
+        The seq formula is volatile and would be recalculated on every edit of the
+        spreadsheet, for all lines, so it is replaced by its value after the append.
+
+        Examples::
+            >>> self.append_journal(118, ['80.22', '94.65', '2.6662', '14:50:13\n\n266.3', '5a2f14f'])
+            3
+        """
+        # Leading ' keeps values as text
+        values = [[row, JOURNAL_SEQ, "'" + datetime_now(format=True), *["'" + str(v) for v in result]]]
+        return self._append_journal_lines(values, sheet)[0]
+
+    def _append_journal_lines(self, lines, sheet):
+        # Append lines with JOURNAL_SEQ, then freeze their seqs, return them
+        response = self._execute(self.service.spreadsheets().values().append(
+            spreadsheetId=self.spreadsheet_id, range=f"{sheet}!A1", valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS", includeValuesInResponse=True,
+            responseValueRenderOption="UNFORMATTED_VALUE", body={'values': lines}))
+        updates = response['updates']
+        seqs = [int(v[1]) for v in updates['updatedData']['values']]
+        first, _ = parse_cell(updates['updatedRange'].rpartition("!")[2].split(":")[0])
+        self._execute(self.service.spreadsheets().values().update(
+            spreadsheetId=self.spreadsheet_id, range=f"{sheet}!B{first}:B{first + len(seqs) - 1}",
+            valueInputOption="RAW", body={'values': [[seq] for seq in seqs]}))
+        return seqs
+
+    def link_journal(self, rows, ranges, update_methods, journal_sheet='Journal', sheet='Sheet1'):
+        r"""
+        Fill cells of `rows` in `sheet` with formulas showing results in the journal: all
+        results of an 'A' column joined by newlines, the last one of a 'W' column. Needed
+        once per row, before its first `append_journal`.
+
+        Results already in the cells are moved to the journal first, one line per repeat
+        with 'W' values on the last one, so they are kept and seqs of later appends count
+        them. Rows already linked are skipped.
+        """
+        assert len(ranges) == len(update_methods)
+        formulas = {}
+        for row in rows:
+            for i, (r, m) in enumerate(zip(ranges, update_methods)):
+                col = column_letter(JOURNAL_RESULT_COLUMN + i)
+                values = f"FILTER({journal_sheet}!{col}:{col},{journal_sheet}!A:A={row})"
+                if m == 'A':
+                    formula = f'=IFERROR(TEXTJOIN(CHAR(10),TRUE,{values}),"")'
+                elif m == 'W':
+                    formula = f'=IFERROR(INDEX({values},COUNTIF({journal_sheet}!A:A,{row})),"")'
+                else:
+                    raise ValueError("Invalid update method: %s" % m)
+                formulas[(row, r)] = formula
+
+        existing = self.read_grid(ranges, rows=rows, sheet=sheet, render='FORMULA') if rows else {}
+        lines = []
+        data = []
+        for row in rows:
+            cells = existing.get(row, [""] * len(ranges))
+            if all(v == formulas[(row, r)] for r, v in zip(ranges, cells)):
+                continue
+            if any(v.startswith("=") for v in cells):
+                raise ValueError(f"Row {row} of {sheet} has formulas, can't be linked to {journal_sheet}")
+            lines += _journal_lines(row, cells, update_methods)
+            for r in ranges:
+                data.append({"range": f"{sheet}!{r}{row}", "values": [[formulas[(row, r)]]]})
+        if lines:
+            self._append_journal_lines(lines, journal_sheet)
+        if data:
+            body = {
+                "valueInputOption": "USER_ENTERED",
+                "data": data,
+            }
+            self._execute(self.service.spreadsheets().values().batchUpdate(
+                spreadsheetId=self.spreadsheet_id, body=body))
+        self.invalidate(sheet)
+
+def _journal_lines(row, cells, update_methods):
+    # Journal lines holding results of cells of a row, one per repeat of 'A' columns
+    repeats = [c.split("\n") if m == 'A' and c != "" else [] for c, m in zip(cells, update_methods)]
+    n = max([len(r) for r in repeats] + [1 if c != "" else 0 for c in cells])
+    lines = []
+    for k in range(n):
+        result = []
+        for c, m, r in zip(cells, update_methods, repeats):
+            if m == 'A':
+                result.append(r[k] if k < len(r) else "")
+            else:
+                result.append(c if k == n - 1 else "")
+        lines.append([row, JOURNAL_SEQ, "", *["'" + v if v else "" for v in result]])
+    return lines
+
+
+def parse_cell(a1):
+    r"""
+    (row, column) of a single cell like 'K118', or None for other ranges.
+    """
+    m = re.fullmatch(r"([A-Za-z]+)(\d+)", a1)
+    if m is None:
+        return None
+    return int(m.group(2)), column_index(m.group(1))
+
+
+def column_index(col):
+    r"""
+    Examples::
+        >>> column_index('A'), column_index('Z'), column_index('AA')
+        (1, 26, 27)
+    """
+    i = 0
+    for ch in col.upper():
+        i = i * 26 + ord(ch) - ord('A') + 1
+    return i
+
+
+def column_letter(i):
+    col = ""
+    while i > 0:
+        i, r = divmod(i - 1, 26)
+        col = chr(ord('A') + r) + col
+    return col
+
+
+def _runs(indices):
+    # Merge sorted unique indices into runs of consecutive ones, [(start, end)]
+    runs = []
+    for i in sorted(set(indices)):
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
         else:
-            i = update_methods.index('A')
-            seq = len(results[0][i].split())
-        return seq
+            runs.append([i, i])
+    return [tuple(r) for r in runs]
 
 
 def update_results(results, new_result, update_methods):
@@ -1,7 +1,14 @@
 from typing import Tuple, Type
 import os
+import mmap
+import hashlib
+import fcntl
+import errno
+import shutil
 import base64
 import time
+import signal
+import subprocess
 from datetime import datetime
 
 from dateutil.parser import parse
@@ -62,4 +69,156 @@ def retry_fn(fn, max_retry, catch: Tuple[Type[Exception], ...], interval=None):
             if i >= max_retry:
                 raise e
             if interval is not None:
-                time.sleep(interval)
\ No newline at end of file
+                time.sleep(interval)
+
+
+def make_env(env_vars=None):
+    env = dict(os.environ)
+    if env_vars is not None:
+        env.update({k: str(v) for k, v in env_vars.items()})
+    return env
+
+
+def popen_group(argv, log_file, env_vars=None, cwd=None):
+    r"""
+    Start `argv` in a new session (and process group) with `env_vars` added to the
+    environment, stdout and stderr redirected to `log_file`.
+    """
+    env = make_env(env_vars)
+    with open(log_file, 'wb') as f:
+        p = subprocess.Popen(
+            argv, env=env, cwd=cwd, stdout=f, stderr=subprocess.STDOUT, start_new_session=True)
+    return p
+
+
+def kill_group(proc, sig=signal.SIGKILL):
+    r"""
+    Send `sig` to the whole process group of `proc` started by `popen_group`, including
+    children left behind after it exits.
+    """
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_group(argv, log_file, env_vars=None, cwd=None):
+    r"""
+    Like `subprocess.run`, but leave no process of the group alive when returned.
+    """
+    p = popen_group(argv, log_file, env_vars, cwd)
+    try:
+        p.wait()
+    finally:
+        kill_group(p)
+        p.wait()
+    return p
+
+
+def format_excerpt(head: bytes, tail: bytes, size):
+    r"""
+    Join the first and last bytes of a file of `size` bytes, marking what is skipped.
+    """
+    if len(head) + len(tail) >= size:
+        # overlapped, the whole file is here
+        data = head + tail[len(head) + len(tail) - size:]
+        return data.decode(errors='replace')
+    skipped = size - len(head) - len(tail)
+    return head.decode(errors='replace') + f"\n... ({skipped} bytes skipped) ...\n" + \
+        tail.decode(errors='replace')
+
+
+def read_excerpt(fp, head_size=8 << 10, tail_size=64 << 10):
+    r"""
+    Read the first `head_size` and last `tail_size` bytes of a log without loading it all.
+    """
+    with open(fp, 'rb') as f:
+        size = f.seek(0, 2)
+        f.seek(0)
+        head = f.read(min(head_size, size))
+        f.seek(max(size - tail_size, 0))
+        tail = f.read()
+    return format_excerpt(head, tail, size)
+
+
+# ioctl to share all extents of a file on btrfs/XFS, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def copy_range(src, dst, offset, count, chunk_size=8 << 20):
+    r"""
+    Copy `count` bytes of binary file `src` from `offset` to the current position of `dst`.
+    The copy is done by the kernel with `copy_file_range`, which shares extents on
+    filesystems supporting reflinks, and falls back to reads and writes.
+    """
+    in_fd, out_fd = src.fileno(), dst.fileno()
+    try:
+        while count > 0:
+            n = os.copy_file_range(in_fd, out_fd, count, offset)
+            if n == 0:
+                return
+            offset += n
+            count -= n
+        return
+    except AttributeError:
+        pass
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+            raise e
+    src.seek(offset)
+    while count > 0:
+        data = src.read(min(count, chunk_size))
+        if not data:
+            return
+        dst.write(data)
+        count -= len(data)
+
+
+def clone_file(src, dst):
+    r"""
+    Copy `src` to `dst` as a reflink if possible, otherwise in kernel without going
+    through user space. A hardlink is not used, because a log can be truncated and
+    rewritten by a later run.
+    """
+    with open(src, 'rb') as f, open(dst, 'wb') as g:
+        try:
+            fcntl.ioctl(g.fileno(), FICLONE, f.fileno())
+        except OSError:
+            copy_range(f, g, 0, os.fstat(f.fileno()).st_size)
+    shutil.copymode(src, dst)
+    return dst
+
+
+def drop_until(fp, marker: bytes = b"Start training"):
+    r"""
+    Remove lines before the first line containing `marker`, or all lines if there is no
+    such line. The marker is found by mmap and the rest of the file is moved by
+    `copy_range`, no line is split or decoded.
+    """
+    with open(fp, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            i = mm.find(marker)
+            start = size if i == -1 else mm.rfind(b"\n", 0, i) + 1
+        if start == 0:
+            return
+        if start == size:
+            os.truncate(fp, 0)
+            return
+        tmp_file = f"{fp}.tmp"
+        with open(tmp_file, 'wb') as g:
+            copy_range(f, g, start, size - start)
+    shutil.copymode(fp, tmp_file)
+    os.replace(tmp_file, fp)
+
+
+def file_digest(fp, tail_size=64 << 10):
+    r"""
+    A cheap fingerprint of a log: its size and hash of its last `tail_size` bytes.
+    """
+    with open(fp, 'rb') as f:
+        size = f.seek(0, 2)
+        f.seek(max(size - tail_size, 0))
+        return f"{size}-{hashlib.blake2b(f.read(), digest_size=16).hexdigest()}"
@@ -0,0 +1,180 @@
+import time
+import signal
+import asyncio
+import subprocess
+
+from hhutil.io import fmt_path, time_now
+from hworkflow.v2.callbacks import validate_callbacks, launch_callbacks, SyncCheckpoint
+from hworkflow.v2.runner import Runner
+from hworkflow.v2.scan import TailScanner
+from hworkflow.v2.trace import Tracer
+from hworkflow.v2.watch import AsyncWatcher
+from hworkflow.utils import kill_group, make_env
+from hworkflow.logbuffer import LogBuffer
+
+# Options of `Runner` not supported yet, with the value disabling them
+_UNSUPPORTED = {
+    'ckpt_pattern': None,
+    'stop_signal': signal.SIGTERM,
+    'stop_timeout': 600,
+    'sample_interval': None,
+    'preload': None,
+    'callback_workers': 1,
+}
+
+
+class AsyncRunner(Runner):
+
+    def __init__(self, *args, **kwargs):
+        r"""
+        asyncio version of `Runner`, so that one process can supervise many tasks and
+        their callbacks at once. Blocking callbacks run in the default executor, and each
+        callback instance is used by one task at a time.
+
+        Checkpoints, stop signals, resource sampling, preload and `callback_workers` are not
+        supported, passing them raises ValueError. Tracing and sync checkpoints are the same
+        as `Runner`.
+
+        Examples::
+            >>> runner = AsyncRunner(work_dir, WORKER_ID=1)
+            >>> await asyncio.gather(*[runner.run(row, callbacks=callbacks) for row in [137, 138]])
+            [True, True]
+            >>> runner.contexts[137]['sheet_seq']
+            1
+        """
+        kwargs.setdefault('sample_interval', None)
+        super().__init__(*args, **kwargs)
+        unsupported = [k for k, v in _UNSUPPORTED.items() if getattr(self, k) != v]
+        if unsupported:
+            raise ValueError(f"AsyncRunner doesn't support {', '.join(unsupported)}")
+        self._callback_locks = {}
+        # Context of the last successful run of each task
+        self.contexts = {}
+
+    async def run_script(self, task_id, log_file, resume_from=None):
+        env = make_env(self.task_envs(task_id, resume_from))
+        fp = self.work_dir / f"{task_id}.py"
+        with open(log_file, 'wb') as f:
+            p = await asyncio.create_subprocess_exec(
+                self._python_exe, '-u', str(fp), stdout=f, stderr=subprocess.STDOUT, env=env,
+                cwd=self.work_dir, start_new_session=True)
+        return p
+
+    async def _kill(self, proc):
+        kill_group(proc)
+        await proc.wait()
+
+    async def run_callbacks(self, callbacks, context, tracer=None, checkpoint_file=None):
+        r"""
+        Like `run_callbacks`, one after another.
+        """
+        done, checkpoint = set(), None
+        if checkpoint_file is not None:
+            checkpoint = SyncCheckpoint(checkpoint_file, callbacks)
+            done = checkpoint.restore(context)
+        for i, c in enumerate(callbacks):
+            if i in done:
+                continue
+            lock = self._callback_locks.setdefault(id(c), asyncio.Lock())
+            async with lock:
+                if tracer is None:
+                    await c.atransform(context)
+                else:
+                    with tracer.span(f"callback:{getattr(c, 'name', type(c).__name__)}"):
+                        await c.atransform(context)
+            if checkpoint is not None:
+                checkpoint.save(context, i)
+
+    async def run(self, task_id, log_file=None, max_retry=10, callbacks=(), log_timeout=None):
+        r"""
+        Return True if the task succeeded, False if it failed with an unknown error, like
+        `Runner.run`. The context of callbacks is kept in `contexts[task_id]`.
+        """
+        self.check_code(task_id)
+        validate_callbacks(callbacks, ['task_id', 'log_file'])
+
+        if log_file is None:
+            log_file = self.work_dir / f"{task_id}.log"
+        else:
+            log_file = fmt_path(log_file)
+
+        retry_session = self.retry_policy.session(max_retry)
+        trace_file = log_file.with_name(f"{log_file.stem}.trace.jsonl") if self.trace else None
+        tracer = Tracer(task_id, trace_file)
+        launch_callbacks(callbacks, task_id, log_file)
+        while True:
+            retry = retry_session.retries
+            is_sleeping = False
+            with tracer.span('spawn', retry=retry):
+                proc = await self.run_script(task_id, log_file)
+            with tracer.span('run', retry=retry) as record:
+                watcher = AsyncWatcher(proc, log_file, self.watch, self.poll_interval)
+                scanner = TailScanner(log_file, self.retry_policy.patterns())
+                start = time.time()
+                try:
+                    while proc.returncode is None:
+                        timeout = None
+                        if log_timeout is not None:
+                            # warmup because first epoch costs much more time
+                            deadline = max(start, self._get_mtime(log_file, start)) + log_timeout
+                            timeout = deadline - time.time()
+                            if timeout <= 0:
+                                print(f"{time_now()} Detect sleeping of {task_id}, kill it")
+                                await self._kill(proc)
+                                is_sleeping = True
+                                break
+                        await watcher.wait(timeout)
+                        if scanner.update() is not None:
+                            kind, text = scanner.match
+                            print(f"{time_now()} Detect {kind} error \"{text}\" of {task_id}, kill it")
+                            await self._kill(proc)
+                            break
+                    else:
+                        scanner.finish()
+                except BaseException as e:
+                    await self._kill(proc)
+                    raise e
+                finally:
+                    watcher.close()
+                    scanner.close()
+                    # Leave nothing of the attempt, e.g. data loader workers
+                    kill_group(proc)
+                record['returncode'] = proc.returncode
+
+            if proc.returncode != 0:
+                with tracer.span('classify', retry=retry) as record:
+                    if is_sleeping:
+                        kind = 'hang'
+                    else:
+                        kind = scanner.match[0] if scanner.match is not None else None
+                    record['kind'] = kind
+                    delay = retry_session.next_delay(kind) if kind is not None else None
+                if kind is None:
+                    # Unknown error, left to user
+                    print(scanner.excerpt())
+                    return False
+                if delay is None:
+                    raise RuntimeError("Failed to run task {} after {} retries, last error: {}".format(
+                        task_id, retry_session.retries - 1, kind))
+                with tracer.span('sleep', retry=retry, kind=kind):
+                    await asyncio.sleep(delay)
+                continue
+            else:
+                self.retry_policy.record(True)
+                context = {
+                    'task_id': task_id,
+                    'log_file': log_file,
+                    'log': LogBuffer(log_file),
+                }
+                try:
+                    with tracer.span('callbacks', retry=retry):
+                        await self.run_callbacks(callbacks, context, tracer,
+                                                 log_file.with_name(f"{log_file.stem}.sync.json"))
+                finally:
+                    context['log'].close()
+                if 'sheet_seq' in context:
+                    print(f"{context['task_id']}-{context['sheet_seq']}")
+                else:
+                    print(f"{context['task_id']}")
+                self.contexts[task_id] = context
+                return True
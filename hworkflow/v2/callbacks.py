@@ -1,12 +1,28 @@
+import os
+import json
+import time
+import asyncio
+import threading
 import pkg_resources
-import subprocess
 
-from itertools import dropwhile
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from github import GithubException
 
-from hhutil.io import read_lines, write_lines, fmt_path, copy, read_text
-from hworkflow.utils import retry_fn
+from hhutil.io import fmt_path
+from hworkflow.utils import retry_fn, drop_until, clone_file, file_digest
+from hworkflow.logbuffer import LogBuffer
+from hworkflow.git import GitHead
+
+
+def get_log(context):
+    r"""
+    The LogBuffer of `context['log_file']` shared by callbacks, created if missing.
+    """
+    log = context.get('log')
+    if log is None or log.path != fmt_path(context['log_file']):
+        log = context['log'] = LogBuffer(context['log_file'])
+    return log
 
 
 class Callback:
@@ -17,11 +33,42 @@ class Callback:
     def produces(self):
         return []
 
+    def modifies(self):
+        # keys (or what they refer to, e.g. content of log_file) changed in place
+        return []
+
+    @property
+    def name(self):
+        return type(self).__name__
+
+    def on_launch(self, context):
+        # called once when the task starts, before its first attempt,
+        # with {task_id, log_file}, to capture state of the code that trains
+        pass
+
     def transform(self, context):
         # default context
         # {task_id, log_file}
         raise NotImplemented
 
+    async def atransform(self, context):
+        # blocking by default, run it in the default executor
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.transform, context)
+
+
+def _transform(callback, context, tracer=None):
+    if tracer is None:
+        return callback.transform(context)
+    with tracer.span(f"callback:{getattr(callback, 'name', type(callback).__name__)}"):
+        return callback.transform(context)
+
+
+def launch_callbacks(callbacks, task_id, log_file):
+    context = {'task_id': task_id, 'log_file': log_file}
+    for c in callbacks:
+        c.on_launch(context)
+
 
 def validate_callbacks(callbacks, initial_context_keys):
     context_keys = set(initial_context_keys)
@@ -32,16 +79,232 @@ def validate_callbacks(callbacks, initial_context_keys):
             context_keys.add(key)
 
 
+class CallbackGraph:
+
+    def __init__(self, callbacks, initial_context_keys):
+        r"""
+        Dependencies of callbacks built from their `requires`, `produces` and `modifies`.
+        A callback depends on the producer of every key it requires, and, in the order of
+        `callbacks`, on earlier modifiers of keys it uses and on earlier readers of keys it
+        modifies.
+
+        Examples::
+            >>> graph = CallbackGraph([CleanLog(), ParseLog(fn), GetDependentRepoCommit('hanser')],
+            >>>                       ['task_id', 'log_file'])
+            >>> graph.deps
+            [set(), {0}, set()]
+        """
+        self.callbacks = list(callbacks)
+        producers = {}
+        for i, c in enumerate(self.callbacks):
+            for key in c.produces():
+                assert key not in producers and key not in initial_context_keys, \
+                    f"{key} is produced by more than one callback"
+                producers[key] = i
+
+        self.deps = []
+        modifiers = {}
+        readers = {}
+        for i, c in enumerate(self.callbacks):
+            deps = set()
+            for key in [*c.requires(), *c.modifies()]:
+                if key in producers:
+                    deps.add(producers[key])
+                else:
+                    assert key in initial_context_keys, f"{key} not found in context"
+                deps.update(modifiers.get(key, []))
+            for key in c.modifies():
+                deps.update(readers.get(key, []))
+            for key in c.requires():
+                readers.setdefault(key, []).append(i)
+            for key in c.modifies():
+                modifiers.setdefault(key, []).append(i)
+            deps.discard(i)
+            self.deps.append(deps)
+        self.order = self._toposort()
+
+    def _toposort(self):
+        n = len(self.callbacks)
+        indegree = [len(d) for d in self.deps]
+        dependents = [[] for _ in range(n)]
+        for i, deps in enumerate(self.deps):
+            for j in deps:
+                dependents[j].append(i)
+        order = []
+        ready = [i for i in range(n) if indegree[i] == 0]
+        while ready:
+            i = ready.pop(0)
+            order.append(i)
+            for j in dependents[i]:
+                indegree[j] -= 1
+                if indegree[j] == 0:
+                    ready.append(j)
+        if len(order) != n:
+            cycle = [type(self.callbacks[i]).__name__ for i in range(n) if i not in order]
+            raise ValueError(f"Cycle in callbacks: {cycle}")
+        return order
+
+    def critical_path(self, durations):
+        r"""
+        The chain of callbacks with the longest total duration.
+        """
+        finish = {}
+        prev = {}
+        for i in self.order:
+            start = max([finish[j] for j in self.deps[i]], default=0)
+            prev[i] = max(self.deps[i], key=lambda j: finish[j], default=None)
+            finish[i] = start + durations.get(i, 0)
+        if not finish:
+            return []
+        i = max(finish, key=finish.get)
+        path = []
+        while i is not None:
+            path.append(i)
+            i = prev[i]
+        return path[::-1]
+
+    def run(self, context, max_workers=4, tracer=None, done=(), on_done=None):
+        r"""
+        Run callbacks in a thread pool as soon as their dependencies finish. Callbacks in
+        `done` are skipped, `on_done(i)` is called after each callback finishes.
+        """
+        durations = {}
+        remaining = [set(d) - set(done) for d in self.deps]
+        pending = set(range(len(self.callbacks))) - set(done)
+        running = {}
+        error = None
+
+        def call(i):
+            start = time.time()
+            try:
+                _transform(self.callbacks[i], context, tracer)
+            finally:
+                durations[i] = time.time() - start
+            if on_done is not None:
+                on_done(i)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    for i in sorted(pending):
+                        if not remaining[i]:
+                            pending.discard(i)
+                            running[executor.submit(call, i)] = i
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    i = running.pop(f)
+                    if f.exception() is not None:
+                        error = error or f.exception()
+                        continue
+                    for r in remaining:
+                        r.discard(i)
+        if error is not None:
+            raise error
+
+        path = self.critical_path(durations)
+        desc = " -> ".join(
+            f"{getattr(self.callbacks[i], 'name', type(self.callbacks[i]).__name__)} ({durations[i]:.1f}s)"
+            for i in path if i in durations)
+        if desc:
+            print(f"Critical path: {desc}, total {sum(durations.get(i, 0) for i in path):.1f}s")
+        return durations
+
+
+class SyncCheckpoint:
+
+    def __init__(self, ckpt_file, callbacks):
+        r"""
+        Save the context and finished callbacks of a sync to `ckpt_file` after each callback,
+        so that a failed sync resumes from where it failed, instead of appending the result
+        to the sheet again. A checkpoint is used only for the same task, callbacks and log,
+        identified by size and hash of its tail before and after each callback changing it.
+
+        Keys of the context must be JSON serializable, except the LogBuffer under 'log'.
+        """
+        self.ckpt_file = fmt_path(ckpt_file)
+        self.callbacks = list(callbacks)
+        self.names = [getattr(c, 'name', type(c).__name__) for c in self.callbacks]
+        self._lock = threading.Lock()
+        self._task_id = None
+        self._done = set()
+        self._log_hashes = []
+
+    def restore(self, context):
+        r"""
+        Load the saved context into `context` if it matches, return indices of finished callbacks.
+        """
+        self._task_id = str(context['task_id'])
+        log_hash = file_digest(context['log_file'])
+        self._done = set()
+        self._log_hashes = [log_hash]
+        try:
+            state = json.loads(self.ckpt_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return set()
+        if state.get('task_id') != self._task_id or state.get('callbacks') != self.names or \
+                log_hash not in state.get('log_hashes', []):
+            return set()
+        saved = state['context']
+        saved['log_file'] = fmt_path(saved['log_file'])
+        context.update(saved)
+        self._done = set(state['done'])
+        self._log_hashes = state['log_hashes']
+        print(f"Resume sync of {self._task_id} after {', '.join(self.names[i] for i in sorted(self._done))}")
+        return set(self._done)
+
+    def save(self, context, i):
+        with self._lock:
+            self._done.add(i)
+            if 'log_file' in self.callbacks[i].modifies():
+                self._log_hashes.append(file_digest(context['log_file']))
+            state = {
+                'task_id': self._task_id,
+                'callbacks': self.names,
+                'done': sorted(self._done),
+                'log_hashes': self._log_hashes,
+                'context': {k: v for k, v in dict(context).items() if k != 'log'},
+            }
+            tmp_file = self.ckpt_file.with_name(self.ckpt_file.name + ".tmp")
+            tmp_file.write_text(json.dumps(state, default=str))
+            os.replace(tmp_file, self.ckpt_file)
+
+
+def run_callbacks(callbacks, context, max_workers=1, tracer=None, checkpoint_file=None):
+    r"""
+    Run callbacks one after another, or concurrently by their dependencies if `max_workers` > 1.
+    Each transform is recorded by `tracer` if given. With `checkpoint_file`, finished callbacks
+    are saved and skipped when the sync of the same log is run again.
+    """
+    graph = CallbackGraph(callbacks, list(context)) if max_workers > 1 else None
+    done, on_done = set(), None
+    if checkpoint_file is not None:
+        checkpoint = SyncCheckpoint(checkpoint_file, callbacks)
+        done = checkpoint.restore(context)
+        on_done = lambda i: checkpoint.save(context, i)
+    if graph is not None:
+        graph.run(context, max_workers, tracer, done, on_done)
+    else:
+        for i, c in enumerate(callbacks):
+            if i in done:
+                continue
+            _transform(c, context, tracer)
+            if on_done is not None:
+                on_done(i)
+
+
 class CleanLog(Callback):
 
     def requires(self):
         return ['log_file']
 
+    def modifies(self):
+        return ['log_file']
+
     def transform(self, context):
-        log_file = context['log_file']
-        lines = read_lines(log_file)
-        lines = list(dropwhile(lambda l: 'Start training' not in l, lines))
-        write_lines(lines, log_file)
+        drop_until(context['log_file'], b"Start training")
+        get_log(context).invalidate()
 
 
 class ParseLog(Callback):
@@ -63,8 +326,7 @@ class ParseLog(Callback):
         return ['parse_result']
 
     def transform(self, context):
-        log_file = context['log_file']
-        result = self.parse_fn(read_text(log_file))
+        result = self.parse_fn(get_log(context).text())
         context['parse_result'] = result
 
 
@@ -82,20 +344,34 @@ class GetDependentRepoCommit(Callback):
         repo_path = fmt_path(repo_path)
         assert repo_path.exists(), f"{repo_path} not found"
         self.repo_path = repo_path
+        self._head = GitHead(repo_path)
+        self._launched = {}
 
     def produces(self):
         return ['repo_commit']
 
+    def on_launch(self, context):
+        self._launched[context['task_id']] = self._head.commit()
+
     def transform(self, context):
-        commit = subprocess.check_output(
-            f'cd {self.repo_path} && git log --format="%h" -n 1', shell=True).decode().strip()
+        # The commit when the task started, or now if it was run elsewhere
+        commit = self._launched.pop(context['task_id'], None)
+        if commit is None:
+            commit = self._head.commit()
         context['repo_commit'] = commit
 
 
 class UpdateSheet(Callback):
 
-    def __init__(self, sheet, sheet_ranges, update_methods, commit_range=None, sub_sheet='Sheet1'):
+    def __init__(self, sheet, sheet_ranges, update_methods, commit_range=None, sub_sheet='Sheet1',
+                 journal_sheet=None):
         r"""
+        Args:
+            journal_sheet: if given, append results to this journal sub-sheet with one request,
+                safe with concurrent appends to the same row, see `GoogleSheet.append_journal`.
+                Each row is linked to the journal with `GoogleSheet.link_journal` before its
+                first append of the process.
+
         Examples::
             >>> sheet_id = "1BxiMVs0XRA5nFMdKvBdBZjgmUUqptlbs74OgvE2upms"
             >>> secret_file = "credentials.json"
@@ -116,6 +392,9 @@ class UpdateSheet(Callback):
         self.update_methods = update_methods
         self.commit_range = commit_range
         self.sub_sheet = sub_sheet
+        self.journal_sheet = journal_sheet
+        self._linked = set()
+        self._link_lock = threading.Lock()
 
     def requires(self):
         r = ['task_id', 'parse_result']
@@ -132,10 +411,20 @@ class UpdateSheet(Callback):
         result = context['parse_result']
         if self.commit_range is not None:
             ranges = [*ranges, self.commit_range]
-            result.append(context['repo_commit'])
+            result = [*result, context['repo_commit']]
             update_methods = [*update_methods, 'A']
-        seq = self.sheet.append_result(
-            context['task_id'], ranges, result, update_methods, sheet=self.sub_sheet)
+        if self.journal_sheet is not None:
+            row = int(context['task_id'])
+            with self._link_lock:
+                if row not in self._linked:
+                    # Rows already linked are skipped by link_journal
+                    self.sheet.link_journal(
+                        [row], ranges, update_methods, journal_sheet=self.journal_sheet, sheet=self.sub_sheet)
+                    self._linked.add(row)
+            seq = self.sheet.append_journal(row, result, sheet=self.journal_sheet)
+        else:
+            seq = self.sheet.append_result(
+                context['task_id'], ranges, result, update_methods, sheet=self.sub_sheet)
         context['sheet_seq'] = seq
 
 
@@ -161,13 +450,18 @@ class RenameLogWithSeq(Callback):
     def requires(self):
         return ['log_file', 'task_id', 'sheet_seq']
 
+    def modifies(self):
+        return ['log_file']
+
     def transform(self, context):
         name = context['task_id']
         seq = context['sheet_seq']
         log_file = context['log_file']
         name = f"{name}" if seq == 1 and not self.suffix1 else f"{name}-{seq}"
         new_log_file = log_file.with_name(name + log_file.suffix)
-        copy(log_file, new_log_file)
+        log = get_log(context)
+        clone_file(log_file, new_log_file)
+        log.rebind(new_log_file)
         context['log_file'] = new_log_file
 
 
@@ -193,7 +487,7 @@ class PushLogToGitHub(Callback):
     def transform(self, context):
         log_file = context['log_file']
         log_name = log_file.stem
-        content = read_text(log_file)
+        content = get_log(context).text()
         path = "log/" + log_name + ".log"
 
         retry_fn(
@@ -0,0 +1,229 @@
+import json
+import time
+import sqlite3
+import threading
+import itertools
+from contextlib import contextmanager
+
+from hhutil.io import fmt_path, time_now
+from hworkflow.retry import ErrorClass
+from hworkflow.utils import clone_file
+from hworkflow.v2.callbacks import Callback
+
+
+class Outbox:
+
+    def __init__(self, db_file, batch_size=16, flush_interval=5, backoff=None):
+        r"""
+        A durable journal of callbacks to run later, e.g. writes to Google Sheets and GitHub,
+        so that a slow or broken remote doesn't block training. Jobs are kept in a SQLite
+        database and run by a background flusher, with backoff on failures. Finished steps
+        of a job are recorded, so a step that succeeded is never replayed, and pending jobs
+        are replayed after a restart once their callbacks are registered again.
+
+        One process should flush an outbox at a time.
+
+        Examples::
+            >>> outbox = Outbox(work_dir / "outbox.db")
+            >>> cb = Deferred(outbox, 'sync', [UpdateSheet(...), RenameLogWithSeq(), PushLogToGitHub(github)])
+            >>> outbox.start()
+            >>> runner.run(461, callbacks=[CleanLog(), ParseLog(parse_fn), cb])
+            >>> outbox.stop()
+        """
+        self.db_file = fmt_path(db_file)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backoff = backoff or ErrorClass('outbox', max_retry=None, base_interval=10, max_interval=600)
+        self._callbacks = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    context TEXT NOT NULL,
+                    step INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_time REAL NOT NULL,
+                    error TEXT,
+                    updated REAL
+                )""")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.db_file), timeout=60, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException as e:
+                conn.execute("ROLLBACK")
+                raise e
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def register(self, name, callbacks):
+        self._callbacks[name] = list(callbacks)
+
+    def put(self, name, context):
+        assert name in self._callbacks, f"{name} is not registered"
+        now = time.time()
+        with self._connect() as conn:
+            c = conn.execute(
+                "INSERT INTO jobs (name, context, next_time, updated) VALUES (?, ?, ?, ?)",
+                (name, _dumps(context), now, now))
+            job_id = c.lastrowid
+        self._wakeup.set()
+        return job_id
+
+    def pending(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'pending'").fetchone()[0]
+
+    def _due(self, limit):
+        names = list(self._callbacks)
+        with self._connect() as conn:
+            return conn.execute(
+                f"SELECT id, name, context, step, attempts FROM jobs "
+                f"WHERE state = 'pending' AND next_time <= ? AND name IN ({','.join('?' * len(names))}) "
+                f"ORDER BY id LIMIT ?", (time.time(), *names, limit)).fetchall()
+
+    def _run_job(self, job_id, name, context, step, attempts):
+        callbacks = self._callbacks[name]
+        context = _loads(context)
+        snapshot = context.get('snapshot')
+        try:
+            for i in range(step, len(callbacks)):
+                callbacks[i].transform(context)
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE jobs SET context = ?, step = ?, updated = ? WHERE id = ?",
+                        (_dumps(context), i + 1, time.time(), job_id))
+        except Exception as e:
+            _close_log(context)
+            delay = self.backoff.interval(attempts + 1, healthy=False)
+            print(f"{time_now()} Outbox job {job_id} of {context.get('task_id')} failed: {e!r}, "
+                  f"retry in {delay:.0f}s")
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE jobs SET attempts = attempts + 1, next_time = ?, error = ?, updated = ? WHERE id = ?",
+                    (time.time() + delay, repr(e), time.time(), job_id))
+            return False
+        _close_log(context)
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'done', updated = ? WHERE id = ?", (time.time(), job_id))
+        if snapshot is not None and fmt_path(snapshot) != context.get('log_file'):
+            fmt_path(snapshot).unlink(missing_ok=True)
+        if 'sheet_seq' in context:
+            print(f"{context['task_id']}-{context['sheet_seq']}")
+        return True
+
+    def flush(self):
+        r"""
+        Run jobs that are due, `batch_size` at a time, until none is left, return the number
+        of jobs done.
+        """
+        done = 0
+        with self._flush_lock:
+            while not self._stop_event.is_set():
+                jobs = self._due(self.batch_size)
+                if not jobs:
+                    break
+                ok = [self._run_job(*job) for job in jobs]
+                done += sum(ok)
+                if not any(ok):
+                    # Remote is down, wait for backoff
+                    break
+        return done
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"{time_now()} Outbox flush failed: {e!r}")
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        r"""
+        Stop the flusher after the running job, pending jobs are kept for the next start.
+        """
+        if self._thread is not None:
+            self._stop_event.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+
+
+class Deferred(Callback):
+
+    _counter = itertools.count()
+
+    def __init__(self, outbox: Outbox, name, callbacks):
+        r"""
+        Put `callbacks` into `outbox` to run in background. The log is snapshotted next to
+        it first, because the runner overwrites it with the next task, and keys they require
+        are saved with it, so they must be JSON serializable.
+
+        Examples::
+            >>> cb = Deferred(outbox, 'sync', [UpdateSheet(...), RenameLogWithSeq(), PushLogToGitHub(github)])
+        """
+        self.outbox = outbox
+        self.callbacks = list(callbacks)
+        self._name = name
+        outbox.register(name, self.callbacks)
+
+    @property
+    def name(self):
+        return f"Deferred({self._name})"
+
+    def requires(self):
+        keys = ['task_id', 'log_file']
+        produced = set()
+        for c in self.callbacks:
+            keys += [k for k in [*c.requires(), *c.modifies()] if k not in produced and k not in keys]
+            produced.update(c.produces())
+        return keys
+
+    def on_launch(self, context):
+        for c in self.callbacks:
+            c.on_launch(context)
+
+    def transform(self, context):
+        log_file = context['log_file']
+        snapshot = log_file.with_name(
+            f"{log_file.stem}.outbox{int(time.time() * 1000)}-{next(self._counter)}{log_file.suffix}")
+        clone_file(log_file, snapshot)
+        job_context = {k: context[k] for k in self.requires()}
+        job_context['log_file'] = snapshot
+        job_context['snapshot'] = snapshot
+        self.outbox.put(self._name, job_context)
+
+
+def _dumps(context):
+    # LogBuffer is reloaded from the file
+    return json.dumps({k: v for k, v in context.items() if k != 'log'}, default=str)
+
+
+def _close_log(context):
+    if 'log' in context:
+        context.pop('log').close()
+
+
+def _loads(s):
+    context = json.loads(s)
+    context['log_file'] = fmt_path(context['log_file'])
+    return context
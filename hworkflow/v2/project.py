@@ -1,9 +1,15 @@
+import time
 from typing import List, Optional
 
 from hhutil.io import fmt_path
 
-from hworkflow.v2.callbacks import CleanLog, ParseLog, GetDependentRepoCommit, UpdateSheet, RenameLogWithSeq, PushLogToGitHub
+from hworkflow.v2.callbacks import run_callbacks, CleanLog, ParseLog, GetDependentRepoCommit, UpdateSheet, RenameLogWithSeq, PushLogToGitHub
 from hworkflow.v2.runner import Runner
+from hworkflow.v2.scheduler import Scheduler
+from hworkflow.v2.trace import Tracer
+from hworkflow.v2.outbox import Outbox, Deferred
+from hworkflow.logbuffer import LogBuffer
+from hworkflow.workqueue import WorkQueue
 from hworkflow.github import Github
 from hworkflow.sheets import GoogleSheet
 
@@ -17,37 +23,99 @@ class Project:
     dep_repo: str
 
     def __init__(self, name, git_repo, sheet_id, access_token, secret_file, token_file,
-                 sub_sheet="Sheet1", worker_id=0, work_dir=None, retry_interval=30, **env_vars):
+                 sub_sheet="Sheet1", worker_id=0, work_dir=None, retry_interval=30, retry_policy=None,
+                 callback_workers=1, outbox=False, sheet_cache_ttl=None, sheet_revision_check=False,
+                 journal_sheet=None, **env_vars):
         self.github = Github(git_repo, name, access_token)
-        self.sheet = GoogleSheet(sheet_id, secret_file, token_file)
+        self.sheet = GoogleSheet(sheet_id, secret_file, token_file, cache_ttl=sheet_cache_ttl,
+                                 revision_check=sheet_revision_check)
+        self.worker_id = worker_id
 
         env_vars = {**env_vars, "WORKER_ID": worker_id, "TASK_NAME": name}
-        self.runner = Runner(work_dir, retry_interval, **env_vars)
+        self.runner = Runner(work_dir, retry_interval, retry_policy=retry_policy,
+                             callback_workers=callback_workers, **env_vars)
 
+        remote_callbacks = [
+            UpdateSheet(self.sheet, self.sheet_ranges, self.update_methods, self.commit_range, sub_sheet,
+                        journal_sheet),
+            RenameLogWithSeq(suffix1=self.log_suffix1),
+            PushLogToGitHub(self.github, retry_interval=retry_interval),
+        ]
+        self.outbox = None
+        if outbox:
+            # Sync results in background, pending ones of a previous run are replayed
+            self.outbox = Outbox(self.runner.work_dir / "outbox.db")
+            remote_callbacks = [Deferred(self.outbox, 'sync', remote_callbacks)]
+            self.outbox.start()
         self._callbacks = [
             CleanLog(),
             ParseLog(self.parse_log),
             GetDependentRepoCommit(self.dep_repo),
-            UpdateSheet(self.sheet, self.sheet_ranges, self.update_methods, self.commit_range, sub_sheet),
-            RenameLogWithSeq(suffix1=self.log_suffix1),
-            PushLogToGitHub(self.github, retry_interval=retry_interval),
+            *remote_callbacks,
         ]
 
     def parse_log(self, content):
         raise NotImplemented
 
     def run_retry(self, row, max_retry=10, log_timeout=None):
-        self.runner.run(row, log_file="train.log", max_retry=max_retry, callbacks=self._callbacks, log_timeout=log_timeout)
+        return self.runner.run(row, log_file="train.log", max_retry=max_retry, callbacks=self._callbacks, log_timeout=log_timeout)
+
+    def run_parallel(self, rows, slots=2, max_retry=10, log_timeout=None, **scheduler_kwargs):
+        r"""
+        Fetch code of `rows` and run them concurrently on `slots` slots of this worker.
+        """
+        for row in rows:
+            self.fetch_code(row)
+        scheduler = Scheduler(self.runner, slots, self._callbacks, **scheduler_kwargs)
+        return scheduler.run(rows, max_retry=max_retry, log_timeout=log_timeout)
+
+    def run_queue(self, queue: WorkQueue, max_retry=10, log_timeout=None, wait=True, idle_interval=60):
+        r"""
+        Pull rows from `queue` and run them until it is empty, or forever if `wait`.
+
+        Examples::
+            >>> queue = WorkQueue("/shared/queue.db", "ImageNet")
+            >>> project.run_queue(queue)
+        """
+        while True:
+            lease = queue.acquire(self.worker_id)
+            if lease is None:
+                if not wait:
+                    break
+                time.sleep(idle_interval)
+                continue
+            row, token = lease
+            with queue.lease(row, token):
+                self.fetch_code(row)
+                if not self.run_retry(row, max_retry=max_retry, log_timeout=log_timeout):
+                    queue.fail(row, token)
 
     def sync_result(self, row, log_file):
         log_file = fmt_path(log_file)
         context = {
             'task_id': row,
             'log_file': log_file,
+            'log': LogBuffer(log_file),
         }
-        for c in self._callbacks:
-            c.transform(context)
-        print(f"{context['task_id']}-{context['sheet_seq']}")
+        trace_file = log_file.with_name(f"{log_file.stem}.trace.jsonl") if self.runner.trace else None
+        tracer = Tracer(row, trace_file)
+        try:
+            with tracer.span('sync'):
+                run_callbacks(self._callbacks, context, self.runner.callback_workers, tracer,
+                              log_file.with_name(f"{log_file.stem}.sync.json"))
+        finally:
+            context['log'].close()
+        if 'sheet_seq' in context:
+            print(f"{context['task_id']}-{context['sheet_seq']}")
+
+    def close(self):
+        if self.outbox is not None:
+            self.outbox.flush()
+            self.outbox.stop()
+            pending = self.outbox.pending()
+            if pending:
+                print(f"{pending} results left in {self.outbox.db_file}, synced on next start")
+        self.runner.close()
 
 
     def fetch_code(self, row):
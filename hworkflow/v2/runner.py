@@ -1,20 +1,94 @@
+import re
 import sys
+import mmap
 import time
-import subprocess
-from datetime import datetime
+import shutil
+import signal
+import threading
 
-from hhutil.io import fmt_path, read_text, time_now
-from hworkflow.v2.callbacks import validate_callbacks
+from hhutil.io import fmt_path, time_now
+from hworkflow.v2.callbacks import validate_callbacks, launch_callbacks, run_callbacks
+from hworkflow.v2.watch import create_watcher
+from hworkflow.v2.scan import TailScanner
+from hworkflow.v2.telemetry import ResourceSampler
+from hworkflow.v2.trace import Tracer
+from hworkflow.logbuffer import LogBuffer
+from hworkflow.retry import RetryPolicy, default_error_classes
+from hworkflow.utils import popen_group, kill_group, make_env
+from hworkflow.v2.zygote import Zygote
+
+
+def stitch_log(log_file, part_file):
+    r"""
+    Append the log of a resumed attempt `part_file` to `log_file`, as if the run was never
+    interrupted. The resumed attempt starts at some "Epoch k/N", so `log_file` is cut before
+    its own "Epoch k/N" (the interrupted epoch and the traceback), and the preamble of
+    `part_file` before it is dropped.
+    """
+    with open(part_file, 'rb') as f:
+        size = f.seek(0, 2)
+        part = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        m = re.search(rb"^Epoch \d+/", part, re.MULTILINE)
+        start = m.start() if m else 0
+        with open(log_file, 'r+b') as g:
+            if m and g.seek(0, 2):
+                with mmap.mmap(g.fileno(), 0, access=mmap.ACCESS_READ) as main:
+                    cut = re.search(b"^" + re.escape(m.group()), main, re.MULTILINE)
+                    cut = cut.start() if cut else len(main)
+                g.truncate(cut)
+                g.seek(cut)
+            f.seek(start)
+            shutil.copyfileobj(f, g)
+        if size:
+            part.close()
+    part_file.unlink()
 
 
 class Runner:
 
-    def __init__(self, work_dir=None, retry_interval=30, **env_vars):
+    def __init__(self, work_dir=None, retry_interval=30, watch='auto', poll_interval=10,
+                 retry_policy=None, ckpt_pattern=None, stop_signal=signal.SIGTERM, stop_timeout=600,
+                 sample_interval=10, preload=None, callback_workers=1,
+                 trace=True, **env_vars):
+        r"""
+        Args:
+            ckpt_pattern: glob pattern of checkpoints in `work_dir`. If given, a retried task is
+                resumed from the newest checkpoint it saved, passed in env `RESUME_FROM`.
+            stop_signal: signal forwarded to the task when the runner receives SIGTERM, the
+                task should save a checkpoint and exit.
+            stop_timeout: seconds to wait for the task to stop before killing it.
+            sample_interval: seconds between samples of resource usage of the task, None to
+                disable. Peak and mean are put in `context['resources']` and the samples are
+                saved to `{log_stem}.resources.csv`.
+            preload: modules to import once in a zygote process, which forks tasks instead of
+                starting a new interpreter for each of them, e.g. ['tensorflow', 'hanser'].
+            callback_workers: if > 1, run independent callbacks concurrently in a thread pool.
+            trace: record durations and errors of spawn, run, failure classification, retry
+                sleeps and each callback to `{log_stem}.trace.jsonl`. Summarize them with
+                `python -m hworkflow.v2.trace`.
+        """
         super().__init__()
         if work_dir is None:
             work_dir = fmt_path("./")
         self.work_dir = work_dir
         self.retry_interval = retry_interval
+        self.watch = watch
+        self.poll_interval = poll_interval
+        if retry_policy is None:
+            retry_policy = RetryPolicy(default_error_classes(retry_interval))
+        self.retry_policy = retry_policy
+        self.ckpt_pattern = ckpt_pattern
+        self.stop_signal = stop_signal
+        self.stop_timeout = stop_timeout
+        self.sample_interval = sample_interval
+        self.preload = preload
+        self.callback_workers = callback_workers
+        self.trace = trace
+        self._zygote = None
+        self._proc = None
+        self._watcher = None
+        self._stop_time = None
+        self._stop_event = threading.Event()
         self.env_vars = env_vars
         self._python_exe = sys.executable
 
@@ -22,97 +96,230 @@ class Runner:
         fp = self.work_dir / f"{task_id}.py"
         assert fp.exists(), "File not exists: {}".format(fp)
 
-    def run_script(self, task_id, log_file):
+    def find_checkpoint(self, since=None):
+        if self.ckpt_pattern is None:
+            return None
+        ckpts = [
+            (fp.stat().st_mtime, fp) for fp in self.work_dir.glob(self.ckpt_pattern)
+        ]
+        ckpts = [(t, fp) for t, fp in ckpts if since is None or t >= since]
+        if not ckpts:
+            return None
+        return max(ckpts)[1]
+
+    def task_envs(self, task_id, resume_from=None):
         envs = {
             "TASK_ID": task_id,
             **self.env_vars,
         }
-        python_exe = self._python_exe
-        env_prefix = " ".join([f"{k}={v}" for k, v in envs.items()])
-        fp = self.work_dir / f"{task_id}.py"
-        cmd = f"{env_prefix} exec {python_exe} -u {fp} > {log_file} 2>&1"
+        if resume_from is not None:
+            envs["RESUME_FROM"] = resume_from
+        return envs
 
-        p = subprocess.Popen(cmd, shell=True)
+    def run_script(self, task_id, log_file, resume_from=None):
+        envs = self.task_envs(task_id, resume_from)
+        fp = self.work_dir / f"{task_id}.py"
+        if self.preload is not None:
+            if self._zygote is None or not self._zygote.alive():
+                self._zygote = Zygote(self.preload)
+            return self._zygote.spawn(fp, log_file, make_env(envs), self.work_dir)
+        argv = [self._python_exe, "-u", str(fp)]
+        p = popen_group(argv, log_file, envs, cwd=self.work_dir)
         return p
 
-    def run(self, task_id, log_file=None, max_retry=10, callbacks=(), log_timeout=None):
+    def close(self):
+        if self._zygote is not None:
+            self._zygote.close()
+            self._zygote = None
+
+    @staticmethod
+    def _get_mtime(log_file, default):
+        try:
+            return log_file.stat().st_mtime
+        except FileNotFoundError:
+            return default
+
+    def _on_stop_signal(self, signum, frame):
+        if self._stop_time is None:
+            print(f"{time_now()} Receive signal {signum}, stop task and wait for checkpoint")
+        self.stop()
+
+    def stop(self, kill=False):
+        r"""
+        Stop the running task like SIGTERM does, e.g. from another thread: forward
+        `stop_signal` to it and kill it after `stop_timeout`, or at once if `kill`. `run`
+        then raises SystemExit(143) instead of retrying.
+        """
+        proc = self._proc
+        running = proc is not None and proc.poll() is None
+        if self._stop_time is None:
+            self._stop_time = time.time()
+            self._stop_event.set()
+            if running:
+                proc.send_signal(self.stop_signal)
+            # Wake up the supervisor to enforce stop_timeout, the wait may not time out
+            watcher = self._watcher
+            if watcher is not None:
+                watcher.wakeup()
+        if kill and running:
+            # The runner kills what is left of the group after the process exits
+            kill_group(proc)
+
+    def _supervise(self, proc, log_file, log_timeout):
+        # Wait for the process, return the error kind and the scanner of its log
+        watcher = self._watcher = create_watcher(proc, log_file, self.watch, self.poll_interval)
+        scanner = TailScanner(log_file, self.retry_policy.patterns())
+        start = time.time()
+        try:
+            while proc.poll() is None:
+                timeout = None
+                if self._stop_time is not None:
+                    timeout = self._stop_time + self.stop_timeout - time.time()
+                    if timeout <= 0:
+                        print(f"{time_now()} Timeout for stopping, kill it")
+                        kill_group(proc)
+                        return None, scanner
+                elif log_timeout is not None:
+                    # warmup because first epoch costs much more time
+                    deadline = max(start, self._get_mtime(log_file, start)) + log_timeout
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        print(f"{time_now()} Detect sleeping, kill it")
+                        kill_group(proc)
+                        return 'hang', scanner
+                watcher.wait(timeout)
+                if scanner.update() is not None and self._stop_time is None:
+                    kind, text = scanner.match
+                    print(f"{time_now()} Detect {kind} error \"{text}\", kill it")
+                    kill_group(proc)
+                    return kind, scanner
+            scanner.finish()
+            return (scanner.match[0] if scanner.match is not None else None), scanner
+        except KeyboardInterrupt as e:
+            kill_group(proc)
+            raise e
+        except Exception as e:
+            kill_group(proc)
+            print(e)
+            exit(1)
+        finally:
+            self._watcher = None
+            watcher.close()
+            scanner.close()
+
+    def run(self, task_id, log_file=None, max_retry=10, callbacks=(), log_timeout=None, resume=False):
+        r"""
+        Return True if the task succeeded, False if it failed with an unknown error, which is
+        left to the user.
+
+        Args:
+            resume: resume the first attempt from the newest checkpoint in `work_dir` if any,
+                otherwise only retries are resumed from checkpoints of this run.
+        """
         self.check_code(task_id)
-        validate_callbacks(callbacks, ['task_id', 'log_file'])
+        initial_keys = ['task_id', 'log_file']
+        if self.sample_interval is not None:
+            initial_keys.append('resources')
+        validate_callbacks(callbacks, initial_keys)
 
         if log_file is None:
             log_file = self.work_dir / f"{task_id}.log"
         else:
             log_file = fmt_path(log_file)
+        part_file = log_file.with_name(f"{log_file.stem}.part{log_file.suffix}")
 
-        retry = 0
-        while True:
-            is_sleeping = False
-            proc = self.run_script(task_id, log_file)
-            poll_count = 0
-            try:
-                poll_interval = 10
-                while proc.poll() is None:
-                    time.sleep(poll_interval)
-                    poll_count += 1
-                    if log_timeout is not None:
-                        if poll_count * poll_interval < log_timeout:
-                            # warmup because first epoch costs much more time
-                            continue
-                        mtime = log_file.stat().st_mtime
-                        if datetime.now().timestamp() - mtime > log_timeout:
-                            print(f"{time_now()} Detect sleeping, kill it")
-                            proc.kill()
-                            is_sleeping = True
-                            break
-            except KeyboardInterrupt as e:
-                proc.kill()
-                raise e
-            except Exception as e:
-                proc.kill()
-                print(e)
-                exit(1)
+        self._proc = None
+        self._stop_time = None
+        self._stop_event = threading.Event()
+        handle_signal = threading.current_thread() is threading.main_thread()
+        if handle_signal:
+            prev_handler = signal.signal(signal.SIGTERM, self._on_stop_signal)
+        try:
+            return self._run(task_id, log_file, part_file, max_retry, callbacks, log_timeout, resume)
+        finally:
+            if handle_signal:
+                signal.signal(signal.SIGTERM, prev_handler)
+            self._proc = None
 
-            if proc.returncode != 0:
-                if is_sleeping:
-                    retry += 1
-                    if retry > max_retry:
-                        raise RuntimeError("Failed to run task {} after {} retries".format(task_id, max_retry))
-                    time.sleep(self.retry_interval)
-                    continue
-                else:
-                    error_log = read_text(log_file)
+    def _run(self, task_id, log_file, part_file, max_retry, callbacks, log_timeout, resume):
+        retry_session = self.retry_policy.session(max_retry)
+        since = None if resume else time.time()
+        resume_from = self.find_checkpoint(since) if resume else None
+        sampler = ResourceSampler(self.sample_interval) if self.sample_interval is not None else None
+        trace_file = log_file.with_name(f"{log_file.stem}.trace.jsonl") if self.trace else None
+        tracer = Tracer(task_id, trace_file)
+        launch_callbacks(callbacks, task_id, log_file)
+        while True:
+            retry = retry_session.retries
+            # The log of a resumed attempt is stitched to the main log after it ends
+            attempt_log = part_file if resume_from is not None and log_file.exists() else log_file
+            if resume_from is not None:
+                print(f"{time_now()} Resume from {resume_from}")
+            with tracer.span('spawn', retry=retry):
+                proc = self._proc = self.run_script(task_id, attempt_log, resume_from)
+                if self._stop_time is not None:
+                    # Stopped while spawning
+                    proc.send_signal(self.stop_signal)
+            with tracer.span('run', retry=retry) as record:
+                if sampler is not None:
+                    sampler.start(proc.pid)
+                try:
+                    kind, scanner = self._supervise(proc, attempt_log, log_timeout)
+                finally:
+                    # Leave nothing of the attempt, e.g. data loader workers
+                    kill_group(proc)
+                    proc.wait()
+                    if sampler is not None:
+                        sampler.stop()
+                        sampler.save(log_file.with_name(f"{log_file.stem}.resources.csv"))
+                record['returncode'] = proc.returncode
+            if attempt_log != log_file:
+                stitch_log(log_file, attempt_log)
 
-                    network_erros = [
-                        "Socket closed",
-                        "Connection reset by peer",
-                    ]
+            if self._stop_time is not None:
+                raise SystemExit(128 + signal.SIGTERM)
 
-                    functional_errors = [
-                        "Stage end",
-                        "Infinite encountered",
-                    ]
+            if proc.returncode != 0:
+                with tracer.span('classify', retry=retry) as record:
+                    if kind is None and proc.returncode == -signal.SIGKILL:
+                        # Not killed by us, which always knows why, but by the OOM killer
+                        kind = 'oom'
+                    record['kind'] = kind
+                    if kind == 'oom' and sampler is not None:
+                        print(f"{time_now()} Killed with peak RSS {sampler.summary().get('rss_peak', 0) / 2 ** 30:.2f} GiB")
+                    delay = retry_session.next_delay(kind) if kind is not None else None
+                if kind is None:
+                    # Unknown error, left to user
                     # TODO: Connection timed out. The process will not return and block forever.
-                    possible_errors = network_erros + functional_errors
-
-                    if any(e in error_log for e in possible_errors):
-                        retry += 1
-                        if retry > max_retry:
-                            raise RuntimeError("Failed to run task {} after {} retries".format(task_id, max_retry))
-                        time.sleep(self.retry_interval)
-                        continue
-                    else:
-                        # Unknown error, left to user
-                        print(error_log)
-                        break
+                    print(scanner.excerpt())
+                    return False
+                if delay is None:
+                    raise RuntimeError("Failed to run task {} after {} retries, last error: {}".format(
+                        task_id, retry_session.retries - 1, kind))
+                with tracer.span('sleep', retry=retry, kind=kind):
+                    # Wake up on SIGTERM, and never launch another attempt after it
+                    self._stop_event.wait(delay)
+                if self._stop_time is not None:
+                    raise SystemExit(128 + signal.SIGTERM)
+                resume_from = self.find_checkpoint(since)
+                continue
             else:
+                self.retry_policy.record(True)
                 self._context = {
                     'task_id': task_id,
                     'log_file': log_file,
+                    'log': LogBuffer(log_file),
                 }
-                for c in callbacks:
-                    c.transform(self._context)
+                if sampler is not None:
+                    self._context['resources'] = sampler.summary()
+                try:
+                    with tracer.span('callbacks', retry=retry):
+                        run_callbacks(callbacks, self._context, self.callback_workers, tracer,
+                                      log_file.with_name(f"{log_file.stem}.sync.json"))
+                finally:
+                    self._context['log'].close()
                 if 'sheet_seq' in self._context:
                     print(f"{self._context['task_id']}-{self._context['sheet_seq']}")
                 else:
                     print(f"{self._context['task_id']}")
-                break
+                return True
@@ -0,0 +1,115 @@
+import re
+
+from hworkflow.utils import format_excerpt
+
+
+def compile_patterns(patterns):
+    # None if there is no pattern, an empty regex would match anything
+    if not patterns:
+        return None
+    group = "|".join(f"(?P<e{i}>{p})" for i, (_kind, p) in enumerate(patterns))
+    return re.compile(group.encode())
+
+
+class TailScanner:
+
+    def __init__(self, log_file, patterns, chunk_size=1 << 20, head_size=8 << 10, tail_size=64 << 10):
+        r"""
+        Incrementally scan new bytes of `log_file` for all error patterns, a list of
+        (kind, regex), at once.
+        Only complete lines are scanned, so a pattern split by a partial write is
+        still found. Each byte is read from disk once.
+
+        The first `head_size` and last `tail_size` bytes are kept for error reporting, the
+        whole log is never held in memory.
+
+        Examples::
+            >>> scanner = TailScanner(log_file, policy.patterns())
+            >>> scanner.update()
+            >>> scanner.update()
+            ('functional', 'Infinite encountered')
+            >>> scanner.match
+            ('functional', 'Infinite encountered')
+            >>> print(scanner.excerpt())
+        """
+        self.log_file = log_file
+        self.patterns = list(patterns)
+        self.chunk_size = chunk_size
+        self.match = None
+        self._regex = compile_patterns(self.patterns)
+        self._f = None
+        self._pending = b""
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self._head = b""
+        self._tail = b""
+        self._size = 0
+
+    def _open(self):
+        if self._f is None:
+            try:
+                self._f = open(self.log_file, 'rb')
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _scan(self, data):
+        if self._regex is None:
+            return self.match
+        m = self._regex.search(data)
+        if m is not None:
+            kind = self.patterns[int(m.lastgroup[1:])][0]
+            self.match = (kind, m.group().decode(errors='replace'))
+        return self.match
+
+    def _keep(self, data):
+        self._size += len(data)
+        if len(self._head) < self.head_size:
+            self._head += data[:self.head_size - len(self._head)]
+        self._tail = (self._tail + data)[-self.tail_size:]
+
+    def _feed(self, final):
+        if not self._open():
+            return self.match
+        while True:
+            data = self._f.read(self.chunk_size)
+            if not data:
+                break
+            self._keep(data)
+            if self.match is not None:
+                continue
+            data = self._pending + data
+            end = data.rfind(b"\n") + 1
+            if end == 0 and len(data) > self.chunk_size:
+                # A very long line, patterns are short
+                end = len(data) - 1024
+            self._pending = data[end:]
+            self._scan(data[:end])
+        if final and self.match is None and self._pending:
+            self._scan(self._pending)
+            self._pending = b""
+        return self.match
+
+    def excerpt(self):
+        r"""
+        The head and tail of the log read so far.
+        """
+        return format_excerpt(self._head, self._tail, self._size)
+
+    def update(self):
+        r"""
+        Scan the complete lines written since last call, return (kind, text) of the
+        first error found or None.
+        """
+        return self._feed(final=False)
+
+    def finish(self):
+        r"""
+        Scan everything left, including the last line without newline.
+        """
+        return self._feed(final=True)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
@@ -0,0 +1,201 @@
+import time
+import queue
+import signal
+import threading
+
+import psutil
+from hhutil.io import copy, time_now
+
+from hworkflow.v2.callbacks import Callback, UpdateSheet
+from hworkflow.v2.runner import Runner
+
+
+class RowLocks:
+
+    def __init__(self):
+        r"""
+        A lock for each row, created on first use.
+        """
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __call__(self, row):
+        with self._lock:
+            return self._locks.setdefault(row, threading.Lock())
+
+
+class SerialCallback(Callback):
+
+    def __init__(self, callback, row_locks: RowLocks):
+        r"""
+        Run `callback` while holding the lock of its row (`task_id`), so that appends of
+        slots to the same row of the sheet don't interleave. Other rows are not blocked.
+        """
+        self.callback = callback
+        self.row_locks = row_locks
+
+    @property
+    def name(self):
+        return getattr(self.callback, 'name', type(self.callback).__name__)
+
+    def requires(self):
+        return self.callback.requires()
+
+    def produces(self):
+        return self.callback.produces()
+
+    def modifies(self):
+        return self.callback.modifies()
+
+    def on_launch(self, context):
+        return self.callback.on_launch(context)
+
+    def transform(self, context):
+        with self.row_locks(context['task_id']):
+            return self.callback.transform(context)
+
+
+class Scheduler:
+
+    def __init__(self, runner: Runner, slots=2, callbacks=(), min_free_memory=4 << 30,
+                 max_cpu_percent=80, admit_interval=60, check_interval=5):
+        r"""
+        Run up to `slots` tasks of `runner` at once on this machine. Every slot has its own
+        work dir (`{work_dir}/slot{i}`) and log file, and gets `SLOT_ID` in env. A new task
+        is admitted only if available memory and system CPU usage leave enough headroom.
+
+        Args:
+            min_free_memory: bytes of available memory required to start a task.
+            max_cpu_percent: system CPU usage above which no task is started.
+            admit_interval: seconds to wait after starting a task before admitting another,
+                so that its memory and CPU usage are visible.
+            check_interval: seconds between resource checks when there is no headroom.
+
+        Examples::
+            >>> scheduler = Scheduler(project.runner, slots=4, callbacks=project._callbacks)
+            >>> scheduler.run([137, 138, 139, 140, 141])
+            {137: None, 138: None, 139: None, 140: None, 141: None}
+        """
+        self.runner = runner
+        self.slots = slots
+        self.min_free_memory = min_free_memory
+        self.max_cpu_percent = max_cpu_percent
+        self.admit_interval = admit_interval
+        self.check_interval = check_interval
+
+        # Only appends to the sheet need to be serialized, per row
+        self._row_locks = RowLocks()
+        self.callbacks = [
+            SerialCallback(c, self._row_locks) if isinstance(c, UpdateSheet) else c for c in callbacks
+        ]
+        self._stop_event = threading.Event()
+        self._admit_lock = threading.Lock()
+        self._last_admit = None
+        self._runners = [self._make_runner(i) for i in range(slots)]
+        # First call of cpu_percent returns a meaningless 0.0
+        psutil.cpu_percent(interval=None)
+
+    def _make_runner(self, slot_id):
+        r = self.runner
+        work_dir = r.work_dir / f"slot{slot_id}"
+        work_dir.mkdir(parents=True, exist_ok=True)
+        env_vars = {**r.env_vars, "SLOT_ID": slot_id}
+        return type(r)(
+            work_dir=work_dir, retry_interval=r.retry_interval, watch=r.watch, poll_interval=r.poll_interval,
+            retry_policy=r.retry_policy, ckpt_pattern=r.ckpt_pattern, stop_signal=r.stop_signal,
+            stop_timeout=r.stop_timeout, sample_interval=r.sample_interval, preload=r.preload,
+            callback_workers=r.callback_workers, trace=r.trace, **env_vars)
+
+    def has_headroom(self):
+        mem = psutil.virtual_memory()
+        cpu = psutil.cpu_percent(interval=None)
+        return mem.available >= self.min_free_memory and cpu <= self.max_cpu_percent
+
+    def _admit(self):
+        with self._admit_lock:
+            if self._last_admit is not None:
+                wait = self._last_admit + self.admit_interval - time.time()
+                if wait > 0:
+                    self._stop_event.wait(wait)
+            while not self.has_headroom() and not self._stop_event.is_set():
+                self._stop_event.wait(self.check_interval)
+            self._last_admit = time.time()
+
+    def _work(self, slot_id, tasks, results, run_kwargs):
+        runner = self._runners[slot_id]
+        while not self._stop_event.is_set():
+            try:
+                task_id = tasks.get_nowait()
+            except queue.Empty:
+                return
+            self._admit()
+            if self._stop_event.is_set():
+                return
+            print(f"{time_now()} Start {task_id} on slot {slot_id}")
+            try:
+                copy(self.runner.work_dir / f"{task_id}.py", runner.work_dir / f"{task_id}.py")
+                ok = runner.run(task_id, log_file=runner.work_dir / "train.log",
+                                callbacks=self.callbacks, **run_kwargs)
+                results[task_id] = None if ok else RuntimeError(f"Task {task_id} failed with an unknown error")
+            except (Exception, SystemExit) as e:
+                print(f"{time_now()} Task {task_id} on slot {slot_id} failed: {e!r}")
+                results[task_id] = e
+
+    def _stop_runners(self, kill=False):
+        for runner in self._runners:
+            runner.stop(kill)
+
+    def _on_stop_signal(self, signum, frame):
+        if not self._stop_event.is_set():
+            print(f"{time_now()} Receive signal {signum}, stop tasks and wait for checkpoints")
+        self._stop_event.set()
+        self._stop_runners()
+
+    def run(self, task_ids, max_retry=10, log_timeout=None):
+        r"""
+        Run all `task_ids` and block until they finish. On SIGTERM, running tasks are
+        stopped like `Runner` does and SystemExit(143) is raised, on other interrupts, e.g.
+        Ctrl-C, they are killed.
+
+        Returns:
+            dict mapping task id to the exception raised, a RuntimeError if it failed with an
+            unknown error, or None.
+        """
+        tasks = queue.Queue()
+        for task_id in task_ids:
+            tasks.put(task_id)
+        results = {}
+        run_kwargs = {'max_retry': max_retry, 'log_timeout': log_timeout}
+        threads = [
+            threading.Thread(target=self._work, args=(i, tasks, results, run_kwargs), daemon=True)
+            for i in range(self.slots)
+        ]
+        self._stop_event.clear()
+        # Slots run in other threads, where Runner can't handle signals
+        handle_signal = threading.current_thread() is threading.main_thread()
+        if handle_signal:
+            prev_handler = signal.signal(signal.SIGTERM, self._on_stop_signal)
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+                    if self._stop_event.is_set():
+                        # Also runners which started a task after the signal
+                        self._stop_runners()
+        except BaseException as e:
+            # Tasks run in their own sessions, they would be left running
+            self._stop_event.set()
+            deadline = time.time() + 10
+            while any(t.is_alive() for t in threads) and time.time() < deadline:
+                self._stop_runners(kill=True)
+                for t in threads:
+                    t.join(0.1)
+            raise e
+        finally:
+            if handle_signal:
+                signal.signal(signal.SIGTERM, prev_handler)
+        if self._stop_event.is_set():
+            raise SystemExit(128 + signal.SIGTERM)
+        return {task_id: results.get(task_id) for task_id in task_ids}
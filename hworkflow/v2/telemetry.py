@@ -0,0 +1,112 @@
+import time
+import threading
+
+import numpy as np
+import psutil
+
+FIELDS = ['time', 'cpu_percent', 'rss', 'read_bytes', 'write_bytes', 'num_threads', 'open_files']
+
+
+class ResourceSampler:
+
+    def __init__(self, interval=10, capacity=8640):
+        r"""
+        Sample resource usage of a process tree every `interval` seconds in a background
+        thread. The latest `capacity` samples are kept in a ring buffer.
+
+        Examples::
+            >>> sampler = ResourceSampler(interval=10)
+            >>> sampler.start(proc.pid)
+            >>> sampler.stop()
+            >>> sampler.summary()
+            {'samples': 360, 'rss_peak': 10485760000, 'rss_mean': 9437184000.0, ...}
+            >>> sampler.save(log_file.with_suffix('.resources.csv'))
+        """
+        self.interval = interval
+        self.capacity = capacity
+        self._buffer = np.zeros((capacity, len(FIELDS)), dtype=np.float64)
+        self._count = 0
+        self._procs = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def _tree(self, root):
+        try:
+            procs = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+        # Reuse Process objects, cpu_percent is measured since the previous call
+        tree = []
+        for p in procs:
+            tree.append(self._procs.setdefault(p.pid, p))
+        return tree
+
+    def sample(self, root):
+        tree = self._tree(root)
+        if not tree:
+            return
+        values = np.zeros(len(FIELDS), dtype=np.float64)
+        values[0] = time.time()
+        for p in tree:
+            try:
+                with p.oneshot():
+                    values[1] += p.cpu_percent(interval=None)
+                    values[2] += p.memory_info().rss
+                    values[5] += p.num_threads()
+                    values[6] += p.num_fds() if hasattr(p, 'num_fds') else len(p.open_files())
+                    try:
+                        io = p.io_counters()
+                        values[3] += io.read_bytes
+                        values[4] += io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        pass
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        with self._lock:
+            self._buffer[self._count % self.capacity] = values
+            self._count += 1
+
+    def _loop(self, root):
+        while not self._stop_event.wait(self.interval):
+            self.sample(root)
+
+    def start(self, pid):
+        r"""
+        Start sampling the process tree of `pid`, samples of previous processes are kept.
+        """
+        self.stop()
+        try:
+            root = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            return
+        self._procs = {}
+        self._tree(root)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, args=(root,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def samples(self):
+        with self._lock:
+            n = min(self._count, self.capacity)
+            start = self._count % self.capacity if self._count > self.capacity else 0
+            return np.roll(self._buffer[:n], -start, axis=0)
+
+    def summary(self):
+        data = self.samples()
+        result = {'samples': len(data)}
+        if len(data) == 0:
+            return result
+        for i, name in enumerate(FIELDS[1:], 1):
+            result[f'{name}_peak'] = data[:, i].max().item()
+            result[f'{name}_mean'] = data[:, i].mean().item()
+        return result
+
+    def save(self, fp):
+        np.savetxt(fp, self.samples(), fmt='%.1f', delimiter=',', header=','.join(FIELDS), comments='')
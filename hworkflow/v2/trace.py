@@ -0,0 +1,93 @@
+import sys
+import json
+import time
+import argparse
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Tracer:
+
+    def __init__(self, task_id, trace_file=None):
+        r"""
+        Record wall time, retry count and exception of phases of a task. Records are
+        appended to `trace_file` as JSON lines, one per phase.
+
+        Examples::
+            >>> tracer = Tracer(461, "train.trace.jsonl")
+            >>> with tracer.span("callback:UpdateSheet", retry=0):
+            >>>     cb.transform(context)
+            >>> tracer.records
+            [{'task_id': 461, 'name': 'callback:UpdateSheet', 'start': 1633000000.0, 'duration': 1.2, 'retry': 0}]
+        """
+        self.task_id = task_id
+        self.trace_file = trace_file
+        self.records = []
+
+    @contextmanager
+    def span(self, name, **attrs):
+        record = {'task_id': self.task_id, 'name': name, 'start': time.time(), **attrs}
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = repr(e)
+            raise e
+        finally:
+            record['duration'] = time.time() - record['start']
+            self.records.append(record)
+            if self.trace_file is not None:
+                with open(self.trace_file, 'a') as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+
+def summarize(records):
+    r"""
+    Count, errors, p50 and p95 of durations for each phase name.
+    """
+    durations = {}
+    errors = {}
+    for r in records:
+        durations.setdefault(r['name'], []).append(r['duration'])
+        errors[r['name']] = errors.get(r['name'], 0) + ('error' in r)
+    summary = {}
+    for name, ds in durations.items():
+        ds = np.array(ds)
+        summary[name] = {
+            'count': len(ds),
+            'errors': errors[name],
+            'p50': np.percentile(ds, 50).item(),
+            'p95': np.percentile(ds, 95).item(),
+            'max': ds.max().item(),
+        }
+    return summary
+
+
+def read_records(files):
+    records = []
+    for fp in files:
+        with open(fp) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize trace files of tasks, e.g. python -m hworkflow.v2.trace *.trace.jsonl")
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--prefix', default=None, help="only phases starting with it, e.g. callback:")
+    args = parser.parse_args(argv)
+
+    records = read_records(args.files)
+    if args.prefix is not None:
+        records = [r for r in records if r['name'].startswith(args.prefix)]
+    summary = summarize(records)
+    width = max([len(name) for name in summary] + [5])
+    print(f"{'phase':<{width}} {'count':>6} {'errors':>6} {'p50':>9} {'p95':>9} {'max':>9}")
+    for name, s in sorted(summary.items(), key=lambda x: -x[1]['p95']):
+        print(f"{name:<{width}} {s['count']:>6} {s['errors']:>6} "
+              f"{s['p50']:>8.2f}s {s['p95']:>8.2f}s {s['max']:>8.2f}s")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,296 @@
+import os
+import asyncio
+import ctypes
+import ctypes.util
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def _open_pidfd(pid):
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def _inotify_open(log_file):
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    # Watch the directory, the log file may not be created yet
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+    wd = _libc.inotify_add_watch(fd, str(log_file.parent).encode(), mask)
+    if wd < 0:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+    return fd
+
+
+def _inotify_drain(fd, name):
+    # Read all pending events, return whether any of them is about `name`
+    name = name.encode()
+    found = False
+    while True:
+        try:
+            buf = os.read(fd, 65536)
+        except BlockingIOError:
+            break
+        offset = 0
+        while offset < len(buf):
+            _wd, _mask, _cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            if buf[offset:offset + length].rstrip(b'\0') == name:
+                found = True
+            offset += length
+    return found
+
+
+class _Wakeup:
+
+    def __init__(self):
+        # A self-pipe, written to wake up a blocked wait, even from a signal handler
+        self._r, self._w = os.pipe()
+        os.set_blocking(self._r, False)
+        os.set_blocking(self._w, False)
+
+    def fileno(self):
+        return self._r
+
+    def set(self):
+        w = self._w
+        if w is None:
+            return
+        try:
+            os.write(w, b"\0")
+        except OSError:
+            # Full, so already woken up, or closed
+            pass
+
+    def drain(self):
+        try:
+            return bool(os.read(self._r, 4096))
+        except BlockingIOError:
+            return False
+
+    def close(self):
+        w, self._w = self._w, None
+        if w is not None:
+            os.close(w)
+            os.close(self._r)
+
+
+class PollWatcher:
+
+    def __init__(self, proc, log_file, poll_interval=10):
+        r"""
+        Wake up every `poll_interval` seconds and report what changed.
+
+        Examples::
+            >>> watcher = PollWatcher(proc, log_file)
+            >>> watcher.wait(timeout=5)
+            {'write'}
+        """
+        self.proc = proc
+        self.log_file = log_file
+        self.poll_interval = poll_interval
+        self._mtime = self._get_mtime()
+        self._wakeup = _Wakeup()
+
+    def _get_mtime(self):
+        try:
+            return self.log_file.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def wait(self, timeout=None):
+        interval = self.poll_interval if timeout is None else min(self.poll_interval, max(timeout, 0))
+        select.select([self._wakeup], [], [], interval)
+        events = set()
+        if self._wakeup.drain():
+            events.add('wakeup')
+        mtime = self._get_mtime()
+        if mtime != self._mtime:
+            self._mtime = mtime
+            events.add('write')
+        if self.proc.poll() is not None:
+            events.add('exit')
+        return events
+
+    def wakeup(self):
+        r"""
+        Return from a blocked `wait` now, safe to call from other threads and signal handlers.
+        """
+        self._wakeup.set()
+
+    def close(self):
+        self._wakeup.close()
+
+
+class InotifyWatcher:
+
+    def __init__(self, proc, log_file, exit_interval=1):
+        r"""
+        Block on inotify events of `log_file` and a pidfd of `proc`, waking up as soon as
+        the log is written or the process exits. Without pidfd support (Linux < 5.3 or
+        Python < 3.9), process exit is checked every `exit_interval` seconds.
+        """
+        self.proc = proc
+        self.log_file = log_file
+        self.exit_interval = exit_interval
+
+        self._fd = _inotify_open(log_file)
+        self._pidfd = _open_pidfd(proc.pid)
+
+        self._wakeup = _Wakeup()
+        self._poller = select.poll()
+        self._poller.register(self._fd, select.POLLIN)
+        self._poller.register(self._wakeup, select.POLLIN)
+        if self._pidfd is not None:
+            self._poller.register(self._pidfd, select.POLLIN)
+
+    def wait(self, timeout=None):
+        if self._pidfd is None:
+            timeout = self.exit_interval if timeout is None else min(self.exit_interval, timeout)
+        ms = None if timeout is None else max(int(timeout * 1000), 0)
+        self._poller.poll(ms)
+        events = set()
+        if self._wakeup.drain():
+            events.add('wakeup')
+        if _inotify_drain(self._fd, self.log_file.name):
+            events.add('write')
+        if self.proc.poll() is not None:
+            events.add('exit')
+        return events
+
+    def wakeup(self):
+        r"""
+        Return from a blocked `wait` now, safe to call from other threads and signal handlers.
+        """
+        self._wakeup.set()
+
+    def close(self):
+        self._wakeup.close()
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def create_watcher(proc, log_file, mode='auto', poll_interval=10):
+    r"""
+    Create a watcher of the training process and its log.
+
+    Args:
+        mode: 'inotify', 'poll' or 'auto' (inotify if available, otherwise poll).
+    """
+    assert mode in ['auto', 'inotify', 'poll']
+    if mode != 'poll':
+        if _libc is not None:
+            try:
+                return InotifyWatcher(proc, log_file)
+            except OSError as e:
+                if mode == 'inotify':
+                    raise e
+        elif mode == 'inotify':
+            raise RuntimeError("inotify is not available on this platform")
+    return PollWatcher(proc, log_file, poll_interval)
+
+
+class AsyncWatcher:
+
+    def __init__(self, proc, log_file, mode='auto', poll_interval=10):
+        r"""
+        asyncio version of the watchers for a `asyncio.subprocess.Process`. Process exit is
+        awaited directly, log writes come from inotify registered to the event loop, or from
+        mtime polling every `poll_interval` seconds.
+
+        Examples::
+            >>> watcher = AsyncWatcher(proc, log_file)
+            >>> await watcher.wait(timeout=5)
+            {'write'}
+        """
+        assert mode in ['auto', 'inotify', 'poll']
+        self.proc = proc
+        self.log_file = log_file
+        self.poll_interval = poll_interval
+        self._loop = asyncio.get_event_loop()
+        self._written = asyncio.Event()
+        self._mtime = None
+        self._fd = None
+        if mode != 'poll':
+            if _libc is not None:
+                try:
+                    self._fd = _inotify_open(log_file)
+                except OSError as e:
+                    if mode == 'inotify':
+                        raise e
+            elif mode == 'inotify':
+                raise RuntimeError("inotify is not available on this platform")
+        if self._fd is not None:
+            self._loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self):
+        if _inotify_drain(self._fd, self.log_file.name):
+            self._written.set()
+
+    def _check_mtime(self):
+        try:
+            mtime = self.log_file.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._written.set()
+
+    async def wait(self, timeout=None):
+        if self._fd is None:
+            timeout = self.poll_interval if timeout is None else min(self.poll_interval, timeout)
+        waits = [
+            asyncio.ensure_future(self.proc.wait()),
+            asyncio.ensure_future(self._written.wait()),
+        ]
+        _done, pending = await asyncio.wait(
+            waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for w in pending:
+            w.cancel()
+        if self._fd is None:
+            self._check_mtime()
+        events = set()
+        if self._written.is_set():
+            self._written.clear()
+            events.add('write')
+        if self.proc.returncode is not None:
+            events.add('exit')
+        return events
+
+    def close(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,259 @@
+import gc
+import io
+import os
+import atexit
+import sys
+import runpy
+import signal
+import socket
+import argparse
+import threading
+import traceback
+import subprocess
+import importlib
+from multiprocessing.connection import Connection, wait
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _run_task(script, log_file, env, cwd):
+    # In the forked child, set up the same environment as `python -u script > log_file 2>&1`
+    code = 1
+    try:
+        os.setsid()
+        for sig in [signal.SIGCHLD, signal.SIGTERM, signal.SIGPIPE]:
+            signal.signal(sig, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.set_wakeup_fd(-1)
+
+        fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        sys.stdout = io.TextIOWrapper(io.FileIO(1, 'w', closefd=False), write_through=True)
+        sys.stderr = io.TextIOWrapper(io.FileIO(2, 'w', closefd=False), write_through=True)
+
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(cwd)
+        sys.argv = [script]
+        sys.path[0] = os.path.dirname(script)
+        runpy.run_path(script, run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            code = _shutdown(code)
+        finally:
+            os._exit(code)
+
+
+def _shutdown(code):
+    # What the interpreter does on exit, os._exit skips it: join non-daemon threads, run
+    # atexit handlers, and flush files (closed by the gc of their objects)
+    try:
+        threading._shutdown()
+    except BaseException:
+        traceback.print_exc()
+    try:
+        atexit._run_exitfuncs()
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            code = e.code
+    except BaseException:
+        traceback.print_exc()
+    gc.collect()
+    for f in [sys.stdout, sys.stderr]:
+        try:
+            f.flush()
+        except Exception:
+            pass
+    return code
+
+
+def serve(conn, modules):
+    failed = []
+    for m in modules:
+        try:
+            importlib.import_module(m)
+        except Exception as e:
+            failed.append(f"{m}: {e!r}")
+
+    # Wake up on SIGCHLD to report exits of tasks immediately
+    rfd, wfd = os.pipe()
+    os.set_blocking(rfd, False)
+    os.set_blocking(wfd, False)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wfd)
+    conn.send(('ready', failed))
+
+    while True:
+        ready = wait([conn, rfd])
+        if rfd in ready:
+            try:
+                os.read(rfd, 4096)
+            except BlockingIOError:
+                pass
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            conn.send(('exit', pid, _exit_code(status)))
+        if conn in ready:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                return
+            if msg[0] == 'spawn':
+                _, script, log_file, env, cwd = msg
+                pid = os.fork()
+                if pid == 0:
+                    conn.close()
+                    os.close(rfd)
+                    os.close(wfd)
+                    _run_task(script, log_file, env, cwd)
+                conn.send(('spawned', pid))
+            elif msg[0] == 'close':
+                return
+
+
+class ZygoteProcess:
+
+    def __init__(self, zygote, pid):
+        r"""
+        A task forked by `Zygote`, with the interface of `subprocess.Popen` used by runners.
+        """
+        self._zygote = zygote
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self._zygote._exits.get(self.pid)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        with self._zygote._cond:
+            ok = self._zygote._cond.wait_for(lambda: self.poll() is not None, timeout)
+        if not ok:
+            raise subprocess.TimeoutExpired(f"zygote task {self.pid}", timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class Zygote:
+
+    def __init__(self, modules=()):
+        r"""
+        A long-lived interpreter that imports heavy `modules` once and forks a child for each
+        task, so tasks and their retries don't pay for the imports again. The child runs the
+        script as `__main__` with the given env, cwd and log file, like `python -u script`.
+
+        Modules imported in the zygote have already read their env vars, so env vars that
+        change their import-time behavior must be set for the runner itself.
+
+        Examples::
+            >>> zygote = Zygote(['tensorflow', 'hanser'])
+            >>> proc = zygote.spawn("/root/461.py", "/root/train.log", env, os.getcwd())
+            >>> proc.wait()
+            0
+            >>> zygote.close()
+        """
+        self.modules = list(modules)
+        parent_sock, child_sock = socket.socketpair()
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "hworkflow.v2.zygote", "--fd", str(child_sock.fileno()), *self.modules],
+            pass_fds=[child_sock.fileno()])
+        child_sock.close()
+        self._conn = Connection(parent_sock.detach())
+
+        msg = self._conn.recv()
+        assert msg[0] == 'ready'
+        for failure in msg[1]:
+            print(f"Zygote failed to import {failure}")
+
+        self._exits = {}
+        self._spawned = []
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            try:
+                msg = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._cond:
+                if msg[0] == 'exit':
+                    self._exits[msg[1]] = msg[2]
+                elif msg[0] == 'spawned':
+                    self._spawned.append(msg[1])
+                self._cond.notify_all()
+
+    def spawn(self, script, log_file, env, cwd):
+        with self._send_lock:
+            self._conn.send(('spawn', str(script), str(log_file), dict(env), str(cwd)))
+            with self._cond:
+                self._cond.wait_for(lambda: self._spawned or not self._reader.is_alive())
+                if not self._spawned:
+                    raise RuntimeError("Zygote exited")
+                pid = self._spawned.pop(0)
+        return ZygoteProcess(self, pid)
+
+    def alive(self):
+        return self._process.poll() is None
+
+    def close(self):
+        try:
+            with self._send_lock:
+                self._conn.send(('close',))
+        except OSError:
+            pass
+        self._conn.close()
+        try:
+            self._process.wait(10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fd', type=int, required=True)
+    parser.add_argument('modules', nargs='*')
+    args = parser.parse_args()
+    serve(Connection(args.fd), args.modules)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from hhutil.io import fmt_path
+
+
+class WorkQueue:
+
+    def __init__(self, db_file, name, lease_time=600, max_attempts=3):
+        r"""
+        A queue of rows shared by workers through a SQLite database on the same host or a
+        shared file system (which must support POSIX locks, NFS often doesn't).
+
+        A worker leases a row and renews the lease with heartbeats while running it. If a
+        worker crashes, its lease expires and the row goes back to the queue, until it has
+        been leased `max_attempts` times. Each lease has a unique token, so a worker whose
+        lease expired can't renew or finish the lease of another one, even with the same id.
+
+        Examples::
+            >>> queue = WorkQueue("/shared/queue.db", "ImageNet")
+            >>> queue.put([461, 462, 463])
+            >>> row, token = queue.acquire(worker_id=1)
+            (461, '1@host:4242:9f0c...')
+            >>> with queue.lease(row, token):
+            >>>     project.run_retry(row)
+        """
+        self.db_file = fmt_path(db_file)
+        self.name = name
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    name TEXT NOT NULL,
+                    row NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated REAL,
+                    PRIMARY KEY (name, row)
+                )""")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.db_file), timeout=60, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException as e:
+                conn.execute("ROLLBACK")
+                raise e
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def put(self, rows):
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (name, row, updated) VALUES (?, ?, ?)",
+                [(self.name, row, now) for row in rows])
+
+    def acquire(self, worker_id):
+        r"""
+        Lease the oldest pending row to `worker_id`, return (row, lease token), or None if
+        there is nothing to do.
+        """
+        token = f"{worker_id}@{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        now = time.time()
+        with self._connect() as conn:
+            # Expired leases of crashed workers
+            conn.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, updated = ? WHERE name = ? AND state = 'leased' AND lease_until < ?",
+                (self.max_attempts, now, self.name, now))
+            r = conn.execute(
+                "SELECT row FROM tasks WHERE name = ? AND state = 'pending' ORDER BY rowid LIMIT 1",
+                (self.name,)).fetchone()
+            if r is None:
+                return None
+            row = r[0]
+            conn.execute(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                "updated = ? WHERE name = ? AND row = ?",
+                (token, now + self.lease_time, now, self.name, row))
+        return row, token
+
+    def heartbeat(self, row, token):
+        r"""
+        Renew the lease, return False if it was lost.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            c = conn.execute(
+                "UPDATE tasks SET lease_until = ?, updated = ? "
+                "WHERE name = ? AND row = ? AND state = 'leased' AND worker = ?",
+                (now + self.lease_time, now, self.name, row, token))
+            return c.rowcount == 1
+
+    def _finish(self, row, token, state):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE tasks SET state = ?, lease_until = NULL, updated = ? "
+                "WHERE name = ? AND row = ? AND state = 'leased' AND worker = ?",
+                (state, time.time(), self.name, row, token))
+
+    def complete(self, row, token):
+        self._finish(row, token, 'done')
+
+    def fail(self, row, token, requeue=False):
+        self._finish(row, token, 'pending' if requeue else 'failed')
+
+    def stats(self):
+        with self._connect() as conn:
+            return dict(conn.execute(
+                "SELECT state, COUNT(*) FROM tasks WHERE name = ? GROUP BY state", (self.name,)).fetchall())
+
+    @contextmanager
+    def lease(self, row, token, heartbeat_interval=None):
+        r"""
+        Send heartbeats in background while running `row`, then mark it done, or failed if
+        an exception is raised. The row is requeued if interrupted. A row finished inside,
+        e.g. by `fail`, is left as is.
+        """
+        if heartbeat_interval is None:
+            heartbeat_interval = self.lease_time / 3
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(heartbeat_interval):
+                try:
+                    if not self.heartbeat(row, token):
+                        print(f"Lease of {row} lost")
+                        return
+                except sqlite3.Error as e:
+                    print(f"Heartbeat of {row} failed: {e!r}")
+
+        t = threading.Thread(target=beat, daemon=True)
+        t.start()
+        try:
+            yield row
+        except BaseException as e:
+            stop.set()
+            t.join()
+            # Interrupted workers give the row back
+            self.fail(row, token, requeue=not isinstance(e, Exception))
+            raise e
+        stop.set()
+        t.join()
+        self.complete(row, token)